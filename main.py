@@ -1,4 +1,5 @@
 ﻿import random
+import copy
 import json
 import re
 import os
@@ -6,23 +7,45 @@ import time
 import asyncio
 import hashlib
 import math
-import urllib.request
-import ssl
-import shutil
+import zlib
 import sqlite3
+import threading
+import multiprocessing
+import queue
 from io import BytesIO
-from functools import lru_cache
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import astrbot.api.message_components as Comp
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 from datetime import datetime, timedelta
 from astrbot.api.all import *
 
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError("请先安装 aiohttp 库: pip install aiohttp")
+
 # === 引入图像处理库 ===
 try:
     from PIL import Image, ImageDraw, ImageFont, ImageFilter
 except ImportError:
     raise ImportError("请先安装 Pillow 库: pip install Pillow")
 
+# === 可选：动画 WebP 输出 (Pillow 未编译 WebP 支持时该档位回退为 GIF) ===
+try:
+    from PIL import features as pil_features
+    WEBP_SUPPORTED = bool(pil_features.check("webp"))
+except Exception:
+    WEBP_SUPPORTED = False
+
+# === 可选：NumPy 批量抽样 (未安装时回退逐个抽取) ===
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # === 路径配置 ===
 PLUGIN_DIR = os.path.join('data', 'plugins', 'astrbot_plugin_openweaponscase', 'data')
 IMAGES_MAP_FILE = os.path.join(PLUGIN_DIR, 'case_images.json')
@@ -30,6 +53,8 @@ HISTORY_FILE = os.path.join(PLUGIN_DIR, 'open_history.json')
 CASES_FILE = os.path.join(PLUGIN_DIR, 'cases.json')
 DB_FILE = os.path.join(PLUGIN_DIR, 'data.db')
 IMAGES_DIR = os.path.join(PLUGIN_DIR, 'images')
+TEMP_DIR = os.path.join(PLUGIN_DIR, 'tmp')
+LEGACY_ATLAS_DIR = os.path.join(PLUGIN_DIR, 'atlas')  # 旧版未压缩图集目录，启动时清理
 
 # ================= 配置区域 =================
 
@@ -65,6 +90,8 @@ PROB_CATEGORY_15 = {"军规级": 0.80128, "受限": 0.16026, "保密": 0.03205,
 NORMAL_DOPPLER_PROBS = {"p1": 0.2, "p2": 0.2, "p3": 0.2, "p4": 0.2, "蓝宝石": 0.1, "红宝石": 0.05, "黑珍珠": 0.05}
 GAMMA_DOPPLER_PROBS = {"p1": 0.2, "p2": 0.2, "p3": 0.2, "p4": 0.2, "绿宝石": 0.2}
 
+RARE_QUALITIES = ("隐秘", "非凡", "Contraband")
+
 ALL_QUALITIES = set().union(*[p.keys() for p in [PROB_CATEGORY_1, PROB_CATEGORY_2, PROB_CATEGORY_3, PROB_CATEGORY_4, PROB_CATEGORY_5, PROB_CATEGORY_6, PROB_CATEGORY_15]])
 
 def get_wear_name(wear_value):
@@ -74,57 +101,490 @@ def get_wear_name(wear_value):
     if wear_value < 0.45: return "破损不堪"
     return "战痕累累"
 
+# ================= 辅助类：别名抽样器 =================
+class AliasSampler:
+    """
+    Walker/Vose 别名表抽样器
+    构建 O(n)，单次抽样 O(1)；权重会按总和归一化
+    """
+    def __init__(self, entries, weights):
+        self.entries = list(entries)
+        n = len(self.entries)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        total = float(sum(weights)) if n else 0.0
+        if n == 0 or total <= 0:
+            self.entries = []
+            return
+
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0: small.append(l)
+            else: large.append(l)
+        # 浮点误差残留项概率视为 1
+        for i in large + small:
+            self.prob[i] = 1.0
+            self.alias[i] = i
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample_index(self, rng=random):
+        col = int(rng.random() * len(self.entries))
+        return col if rng.random() < self.prob[col] else self.alias[col]
+
+    def sample(self, rng=random):
+        return self.entries[self.sample_index(rng)]
+
+    def sample_indices(self, n, np_rng):
+        """批量抽取 n 个下标 (需要 NumPy)，返回 ndarray"""
+        if not hasattr(self, "_np_prob"):
+            self._np_prob = np.asarray(self.prob, dtype=np.float64)
+            self._np_alias = np.asarray(self.alias, dtype=np.intp)
+        cols = np_rng.integers(0, len(self.entries), size=n)
+        accept = np_rng.random(n) < self._np_prob[cols]
+        return np.where(accept, cols, self._np_alias[cols])
+
+WEAR_SAMPLER = AliasSampler(WEAR_LEVELS, [wl[1] for wl in WEAR_LEVELS])
+DOPPLER_WEAR_SAMPLER = AliasSampler(DOPPLER_WEAR_LEVELS, [wl[1] for wl in DOPPLER_WEAR_LEVELS])
+NORMAL_DOPPLER_SAMPLER = AliasSampler(NORMAL_DOPPLER_PROBS.keys(), NORMAL_DOPPLER_PROBS.values())
+GAMMA_DOPPLER_SAMPLER = AliasSampler(GAMMA_DOPPLER_PROBS.keys(), GAMMA_DOPPLER_PROBS.values())
+
 # ================= 辅助类：网络请求 =================
+BROWSER_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+class AsyncHttpClient:
+    """
+    共享异步 HTTP 客户端 (API 与图片 CDN 共用)
+    - 单个 aiohttp 会话，按 host 复用 keep-alive 连接
+    - 每个 host 独立的并发上限
+    - 超时/连接错误/5xx/429 按指数退避 + 随机抖动重试，不阻塞事件循环
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, per_host_limit=4, timeout=20, max_retries=3, backoff_base=0.5, backoff_max=8.0, host_limits=None):
+        self.per_host_limit = max(1, per_host_limit)
+        self.host_limits = host_limits or {}
+        self.timeout = timeout
+        self.max_retries = max(1, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+        self._host_sems = {}
+        self.metrics = {}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=0, ssl=False, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _host_state(self, host):
+        if host not in self._host_sems:
+            self._host_sems[host] = asyncio.Semaphore(self.host_limits.get(host, self.per_host_limit))
+            self.metrics[host] = {"requests": 0, "retries": 0, "errors": 0, "ms": 0.0}
+        return self._host_sems[host], self.metrics[host]
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def fetch(self, url, method="GET", headers=None, data=None, timeout=None, max_retries=None):
+        """返回响应体 bytes；重试耗尽后抛出最后一次异常"""
+        host = urlsplit(url).hostname
+        sem, stats = self._host_state(host)
+        retries = max_retries or self.max_retries
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        for attempt in range(retries):
+            try:
+                async with sem:
+                    started = time.perf_counter()
+                    stats["requests"] += 1
+                    try:
+                        async with self._get_session().request(method, url, headers=headers, data=data, timeout=client_timeout) as resp:
+                            if resp.status in self.RETRY_STATUS:
+                                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=resp.reason or "")
+                            resp.raise_for_status()
+                            return await resp.read()
+                    finally:
+                        stats["ms"] += (time.perf_counter() - started) * 1000
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in self.RETRY_STATUS
+                if not retryable or attempt == retries - 1:
+                    stats["errors"] += 1
+                    raise
+                stats["retries"] += 1
+                await asyncio.sleep(self._backoff(attempt))
+
+    def stats(self):
+        return {host: dict(m) for host, m in self.metrics.items()}
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
 class NetworkManager:
-    def __init__(self, api_token):
-        self.ssl_context = ssl._create_unverified_context()
+    def __init__(self, api_token, http_client):
+        self.http = http_client
         self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'User-Agent': BROWSER_UA,
             'Referer': 'https://buff.163.com/',
             'Content-Type': 'application/json',
             'ApiToken': api_token
         }
 
-    def request(self, url, method="GET", data=None, max_retries=3):
+    async def request(self, url, method="GET", data=None, max_retries=3):
         if data: data = data.encode('utf-8')
         if not url.startswith("http"): url = "https://" + url
-        for attempt in range(max_retries):
-            try:
-                req = urllib.request.Request(url, data=data, headers=self.headers, method=method)
-                with urllib.request.urlopen(req, context=self.ssl_context, timeout=20) as response:
-                    return json.loads(response.read().decode('utf-8'))
-            except Exception as e:
-                if attempt == max_retries - 1: raise e
-                time.sleep(2)
+        body = await self.http.fetch(url, method=method, headers=self.headers, data=data, max_retries=max_retries)
+        return json.loads(body.decode('utf-8'))
+
+# ================= 辅助类：令牌桶限流 =================
+class TokenBucket:
+    """
+    异步令牌桶：rate 为每秒补充的令牌数，capacity 为允许的突发量
+    capacity=1 时相邻两次请求间隔严格不小于 1/rate 秒
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = max(0.01, float(rate))
+        self.capacity = max(1, int(capacity))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited += wait
+                await asyncio.sleep(wait)
+
+# ================= 辅助类：价格查询 =================
+class PriceService:
+    """
+    异步价格查询：搜索结果按规范化关键词缓存，商品详情按 goods id 缓存 (TTL)
+    相同 key 的并发请求合并为一次上游调用 (single-flight)，上游调用统一走全局限流
+    """
+    SEARCH_TTL = 6 * 3600
+    MAX_ENTRIES = 2048
+
+    def __init__(self, net_mgr, api_base, limiter, ttl=300):
+        self.net_mgr = net_mgr
+        self.api_base = api_base
+        self.limiter = limiter
+        self.ttl = ttl
+        self._cache = {}
+        self._inflight = {}
+        self.metrics = {"hits": 0, "misses": 0, "coalesced": 0, "upstream": 0, "upstream_errors": 0,
+                        "upstream_ms": 0.0, "upstream_max_ms": 0.0}
+
+    @staticmethod
+    def normalize(keyword):
+        return " ".join(keyword.lower().split())
+
+    async def _cached(self, key, ttl, loader):
+        entry = self._cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.metrics["hits"] += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task:
+            self.metrics["coalesced"] += 1
+            return await asyncio.shield(task)
+        self.metrics["misses"] += 1
+        task = asyncio.ensure_future(loader())
+        self._inflight[key] = task
+        try:
+            value = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(key, None)
+        if value is not None:
+            if len(self._cache) >= self.MAX_ENTRIES: self._prune()
+            self._cache[key] = (time.monotonic() + ttl, value)
+        return value
+
+    def _prune(self):
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in self._cache.items() if exp <= now]:
+            del self._cache[k]
+        while len(self._cache) >= self.MAX_ENTRIES:
+            self._cache.pop(next(iter(self._cache)))
+
+    async def _request(self, path):
+        await self.limiter.acquire()
+        started = time.perf_counter()
+        self.metrics["upstream"] += 1
+        try:
+            return await self.net_mgr.request(f"{self.api_base}{path}")
+        except Exception:
+            self.metrics["upstream_errors"] += 1
+            raise
+        finally:
+            cost = (time.perf_counter() - started) * 1000
+            self.metrics["upstream_ms"] += cost
+            self.metrics["upstream_max_ms"] = max(self.metrics["upstream_max_ms"], cost)
+
+    async def search_items(self, keyword):
+        async def load():
+            d = await self._request(f"/api/v1/search/suggest?text={quote(keyword)}")
+            return d.get('data', []) if d and d.get('code')==200 else None
+        return await self._cached(("search", self.normalize(keyword)), self.SEARCH_TTL, load)
+
+    async def get_goods_info(self, gid):
+        async def load():
+            d = await self._request(f"/api/v1/info/good?id={gid}")
+            if not d or d.get('code')!=200: return None
+            g = d['data']['goods_info']
+            return {
+                "名称": g['name'], 
+                "BUFF": g['buff_sell_price'], 
+                "YYYP": g.get('yyyp_sell_price', '无'),
+                "Steam": g['steam_sell_price'], 
+                "img": g['img'], 
+                "更新": g['updated_at']
+            }
+        return await self._cached(("goods", str(gid)), self.ttl, load)
+
+    async def get_price(self, name):
+        items = await self.search_items(name)
+        if not items: return "❌ 未找到"
+        info = await self.get_goods_info(items[0]['id'])
+        if not info: return "❌ 详情获取失败"
+        return f"{info['img']}\n{info['名称']}\nBUFF: {info['BUFF']} | YYYP: {info['YYYP']}\nSteam: {info['Steam']}"
+
+    def stats(self):
+        m = dict(self.metrics)
+        lookups = m["hits"] + m["misses"] + m["coalesced"]
+        m["hit_rate"] = (m["hits"] + m["coalesced"]) / lookups if lookups else 0.0
+        m["upstream_avg_ms"] = m["upstream_ms"] / m["upstream"] if m["upstream"] else 0.0
+        m["entries"] = len(self._cache)
+        return m
+
+# ================= 辅助类：解码图片内存缓存 =================
+class DecodedImageCache:
+    """
+    按字节预算淘汰的解码图片 LRU 缓存 (线程安全，渲染线程可直接读取)
+    key 为 (url, size)，size=None 表示原图，其余为缩略图尺寸
+    也可存放其他对象，此时由 put() 传入占用字节数
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, int(max_bytes))
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _cost(img):
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.metrics["hits"] += 1
+            return entry[0]
+
+    def put(self, key, img, cost=None):
+        if img is None: return
+        if cost is None: cost = self._cost(img)
+        if cost > self.max_bytes: return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None: self._bytes -= old[1]
+            self._data[key] = (img, cost)
+            self._bytes += cost
+            while self._bytes > self.max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted[1]
+                self.metrics["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics, entries=len(self._data), bytes=self._bytes, max_bytes=self.max_bytes)
 
 # ================= 辅助类：图片管理 =================
 class ImageManager:
-    def __init__(self, retention_days: int = 0):
-        os.makedirs(IMAGES_DIR, exist_ok=True)
-        self.ssl_context = ssl._create_unverified_context()
-        self._cleanup_cache(retention_days)
+    HEADERS = {
+        'User-Agent': BROWSER_UA,
+        'Referer': 'https://buff.163.com/',
+        'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8'
+    }
 
-    def _cleanup_cache(self, retention_days: int):
-        if retention_days <= 0:
-            return
-        cutoff = time.time() - (retention_days * 86400)
-        try:
-            for name in os.listdir(IMAGES_DIR):
-                path = os.path.join(IMAGES_DIR, name)
-                try:
-                    if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
-                        os.remove(path)
-                except Exception:
-                    continue
-        except Exception:
-            pass
+    # 超出容量上限时淘汰到上限的该比例，避免每轮只删一两个文件
+    EVICT_LOW_WATERMARK = 0.9
+
+    def __init__(self, http_client, retention_days: int = 0, memory_cache_bytes: int = 64 * 1024 * 1024,
+                 max_disk_bytes: int = 0):
+        os.makedirs(IMAGES_DIR, exist_ok=True)
+        self.http = http_client
+        self.memory = DecodedImageCache(memory_cache_bytes)
+        self.retention_days = retention_days
+        self.max_disk_bytes = max_disk_bytes
+        self._inflight = {}
+        # 磁盘缓存索引 {文件名: [url, size, last_access]}，变更先记在内存中，由维护任务批量落库
+        self._index = {}
+        self._dirty = set()
+        self._removed = set()
+        self.disk_bytes = 0
+        self.metrics = {"downloads": 0, "download_failures": 0, "coalesced": 0, "evicted": 0, "evicted_bytes": 0}
+
+    def load_index(self, rows):
+        """
+        从数据库载入磁盘缓存索引
+        索引为空而目录中已有文件时 (首次升级) 扫描一次目录补建索引，并删除旧版遗留的临时输出文件
+        """
+        self._index = {f: [url, size, last_access] for f, url, size, last_access in rows}
+        if not self._index:
+            try:
+                with os.scandir(IMAGES_DIR) as it:
+                    for entry in it:
+                        if not entry.is_file(): continue
+                        if entry.name.startswith(("temp_", "cover_", "inv_")) or entry.name.endswith(".tmp"):
+                            try: os.remove(entry.path)
+                            except OSError: pass
+                            continue
+                        st = entry.stat()
+                        self._index[entry.name] = [None, st.st_size, st.st_mtime]
+                        self._dirty.add(entry.name)
+            except OSError:
+                pass
+        self.disk_bytes = sum(v[1] for v in self._index.values())
+
+    def _touch(self, url, file_path, size=None):
+        name = os.path.basename(file_path)
+        entry = self._index.get(name)
+        if entry is None:
+            if size is None:
+                try: size = os.path.getsize(file_path)
+                except OSError: return
+            entry = self._index[name] = [url, size, 0.0]
+            self.disk_bytes += size
+        elif size is not None and size != entry[1]:
+            self.disk_bytes += size - entry[1]
+            entry[1] = size
+        entry[0] = entry[0] or url
+        entry[2] = time.time()
+        self._dirty.add(name)
+        self._removed.discard(name)
+
+    def track_file(self, file_path, size=None):
+        """登记由其他组件写入缓存目录的派生文件 (如图集)，使其计入容量上限并参与 LRU 淘汰"""
+        self._touch(None, file_path, size)
+
+    def discard(self, names):
+        """同步删除指定缓存文件并移出索引 (用于已失效的少量派生文件)"""
+        for name in self._remove_files(names):
+            entry = self._index.pop(name, None)
+            if entry is None: continue
+            self.disk_bytes -= entry[1]
+            self._dirty.discard(name)
+            self._removed.add(name)
+
+    def _pick_evictions(self):
+        """按最近访问时间挑出需要淘汰的文件 (过期优先，其次超出容量部分)"""
+        victims = []
+        if self.retention_days > 0:
+            cutoff = time.time() - self.retention_days * 86400
+            victims = [n for n, v in self._index.items() if v[2] < cutoff]
+        remaining = self.disk_bytes - sum(self._index[n][1] for n in victims)
+        if self.max_disk_bytes > 0 and remaining > self.max_disk_bytes:
+            target = self.max_disk_bytes * self.EVICT_LOW_WATERMARK
+            chosen = set(victims)
+            for name, v in sorted(self._index.items(), key=lambda kv: kv[1][2]):
+                if remaining <= target: break
+                if name in chosen: continue
+                victims.append(name)
+                remaining -= v[1]
+        # 正在下载的文件不淘汰
+        busy = {os.path.basename(self._get_file_path(u)) for u in self._inflight}
+        return [n for n in victims if n not in busy]
+
+    @staticmethod
+    def _remove_files(names):
+        """删除文件 (在线程中执行)，返回成功删除的文件名；删除失败 (如被占用) 的留待下轮再试"""
+        removed = []
+        for name in names:
+            try:
+                os.remove(os.path.join(IMAGES_DIR, name))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            removed.append(name)
+        return removed
+
+    async def _drop(self, names):
+        """删除文件并更新索引，返回 (删除数量, 释放字节)"""
+        started = time.time()
+        removed = await asyncio.to_thread(self._remove_files, names)
+        count = freed = 0
+        for name in removed:
+            entry = self._index.get(name)
+            # 删除期间又被访问或重新下载的条目保留，由下次访问修正
+            if entry is None or entry[2] > started: continue
+            del self._index[name]
+            self.disk_bytes -= entry[1]
+            self._dirty.discard(name)
+            self._removed.add(name)
+            count += 1
+            freed += entry[1]
+        return count, freed
+
+    async def maintain(self, db_writer):
+        """后台维护：淘汰过期 / 超出容量的文件，并把索引变更批量写入数据库"""
+        victims = self._pick_evictions()
+        if victims:
+            count, freed = await self._drop(victims)
+            self.metrics["evicted"] += count
+            self.metrics["evicted_bytes"] += freed
+        await self.flush_index(db_writer)
+
+    async def flush_index(self, db_writer):
+        if not self._dirty and not self._removed: return
+        upserts = [(n, *self._index[n]) for n in self._dirty if n in self._index]
+        removed = list(self._removed)
+        self._dirty.clear()
+        self._removed.clear()
+        await db_writer.submit(DatabaseManager.save_image_index_tx, upserts, removed)
+
+    async def clear_disk(self, db_writer):
+        """逐个删除已索引的缓存文件 (不删除目录，进行中的读取/下载不受影响)，返回删除数量"""
+        count, _ = await self._drop(list(self._index))
+        self.memory.clear()
+        await self.flush_index(db_writer)
+        return count
+
+    def disk_stats(self):
+        return {"files": len(self._index), "bytes": self.disk_bytes, "max_bytes": self.max_disk_bytes,
+                "evicted": self.metrics["evicted"], "evicted_bytes": self.metrics["evicted_bytes"]}
 
     def _get_file_path(self, url):
         hash_name = hashlib.md5(url.encode()).hexdigest()
         return os.path.join(IMAGES_DIR, f"{hash_name}.png")
 
-    @lru_cache(maxsize=128)
-    def get_cached_image(self, file_path):
+    def _load_from_disk(self, file_path):
         try:
             if os.path.exists(file_path) and os.path.getsize(file_path) > 100:
                 img = Image.open(file_path).convert("RGBA")
@@ -132,158 +592,450 @@ class ImageManager:
         except: return None
         return None
 
+    def load_cached(self, url):
+        """只读本地缓存 (内存 → 磁盘) 取图，不发起下载；供渲染进程使用"""
+        if not url: return None
+        img = self.memory.get((url, None))
+        if img is None:
+            img = self._load_from_disk(self._get_file_path(url))
+            self.memory.put((url, None), img)
+        return img
+
+    def thumbnail(self, url, img, size):
+        """
+        取 url 对应图片的缩略图 (结果进入内存缓存，供渲染线程重复使用)
+        返回的图片为共享对象，调用方不得原地修改
+        """
+        if img is None: return None
+        key = (url, tuple(size))
+        thumb = self.memory.get(key) if url else None
+        if thumb is None:
+            thumb = img.copy()
+            thumb.thumbnail(size, Image.Resampling.BICUBIC)
+            if url: self.memory.put(key, thumb)
+        return thumb
+
     async def get_image(self, url):
+        """返回解码后的原图 (共享对象，调用方不得原地修改)"""
         if not url: return None
         file_path = self._get_file_path(url)
+        img = self.memory.get((url, None))
+        if img is not None:
+            self._touch(url, file_path)
+            return img
         if os.path.exists(file_path):
-            return self.get_cached_image(file_path)
+            img = await asyncio.to_thread(self._load_from_disk, file_path)
+            if img is not None:
+                self._touch(url, file_path)
+                self.memory.put((url, None), img)
+                return img
+            # 文件恰好被淘汰或已损坏时回退到重新下载
+        # 同一 URL 的并发请求共享一次下载
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._download(url, file_path))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        else:
+            self.metrics["coalesced"] += 1
         try:
-            return await asyncio.to_thread(self._download_sync, url, file_path)
+            return await asyncio.shield(task)
         except: return None
 
-    def _download_sync(self, url, file_path):
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Referer': 'https://buff.163.com/',
-            'Accept': 'image/webp,image/apng,image/*,*/*;q=0.8'
+    async def _download(self, url, file_path):
+        self.metrics["downloads"] += 1
+        try:
+            data = await self.http.fetch(url, headers=self.HEADERS, timeout=15)
+            if len(data) < 100: raise ValueError("图片数据过小")
+            img = await asyncio.to_thread(self._store_and_decode, data, file_path)
+            self._touch(url, file_path, len(data))
+            self.memory.put((url, None), img)
+            return img
+        except Exception:
+            self.metrics["download_failures"] += 1
+            return None
+
+    def _store_and_decode(self, data, file_path):
+        img = Image.open(BytesIO(data)).convert("RGBA")
+        # 先写临时文件再原子替换，读取方不会看到写了一半的文件
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f: f.write(data)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        return img
+
+# ================= 辅助类：生成图片输出 =================
+class TempOutputManager:
+    """
+    开箱动图、封面、库存卡片等一次性输出文件的暂存区
+    每次写入使用唯一文件名，并发请求互不覆盖；记录创建时间，超过存活时间后由维护任务回收
+    默认放在插件数据目录 (协议端在其他容器中运行时也能按路径读取)，可配置为 /dev/shm 等内存目录
+    每个插件实例使用独立子目录，只回收自己写入的文件；其他实例或上次运行遗留的文件超过存活时间后才清理
+    """
+    INSTANCE_DIR_RE = re.compile(r"^[0-9a-f]{8}_\d+_[0-9a-f]{6}$")
+
+    def __init__(self, base_dir=None, ttl=600):
+        # 文件路径交给协议端读取，使用绝对路径
+        self.base_dir = os.path.abspath(base_dir or TEMP_DIR)
+        self.ttl = ttl
+        tag = hashlib.md5(os.path.abspath(PLUGIN_DIR).encode()).hexdigest()[:8]
+        self.directory = os.path.join(self.base_dir, f"{tag}_{os.getpid()}_{os.urandom(3).hex()}")
+        self._files = {}
+        self.metrics = {"written": 0, "reaped": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self._sweep_stale()
+
+    def _sweep_stale(self):
+        """删除其他实例目录中超过存活时间的文件，并移除已清空的目录"""
+        cutoff = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.base_dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_file() and self.base_dir == os.path.abspath(TEMP_DIR):
+                    # 旧版直接写在 tmp/ 下的输出文件
+                    if entry.stat().st_mtime < cutoff: os.remove(entry.path)
+                    continue
+                if not entry.is_dir() or entry.path == self.directory or not self.INSTANCE_DIR_RE.match(entry.name):
+                    continue
+                for f in os.scandir(entry.path):
+                    if f.is_file() and f.stat().st_mtime < cutoff: os.remove(f.path)
+                os.rmdir(entry.path)
+            except OSError:
+                pass
+
+    def write(self, name, data):
+        """写入输出文件并登记，返回文件路径；name 只决定前缀与扩展名"""
+        stem, ext = os.path.splitext(name)
+        path = os.path.join(self.directory, f"{stem}_{os.urandom(6).hex()}{ext}")
+        with open(path, "wb") as f: f.write(data)
+        self._files[path] = time.time()
+        self.metrics["written"] += 1
+        return path
+
+    def reap(self):
+        """删除超过存活时间的输出文件，返回删除数量"""
+        cutoff = time.time() - self.ttl
+        count = 0
+        for path, created in list(self._files.items()):
+            if created >= cutoff: continue
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            except OSError: continue
+            del self._files[path]
+            count += 1
+        self.metrics["reaped"] += count
+        return count
+
+    def stats(self):
+        return dict(self.metrics, live=len(self._files))
+
+class MediaOutput:
+    """
+    生成图片的发送方式
+    bytes: 直接以字节发送 (Comp.Image.fromBytes)，不落盘
+    file: 写入暂存区的唯一文件后按路径发送
+    auto: 已知支持字节图片的平台发送字节，其余平台写文件
+    """
+    MODES = ("auto", "bytes", "file")
+    BYTES_PLATFORMS = {"aiocqhttp", "qq_official", "qq_official_webhook", "telegram", "webchat"}
+
+    def __init__(self, mode="auto", spool=None):
+        self.mode = mode if mode in self.MODES else "auto"
+        # 未显式配置暂存目录时使用插件数据目录
+        self.spool = spool or TempOutputManager()
+        self.metrics = {"bytes": 0, "files": 0}
+
+    def _use_bytes(self, event):
+        if not hasattr(Comp.Image, "fromBytes"): return False
+        if self.mode != "auto": return self.mode == "bytes"
+        try:
+            return event.get_platform_name() in self.BYTES_PLATFORMS
+        except Exception:
+            return False
+
+    def image(self, event, data, name):
+        """返回可直接放入消息链的图片组件；name 为文件模式下的文件名前缀与扩展名"""
+        if self._use_bytes(event):
+            self.metrics["bytes"] += 1
+            return Comp.Image.fromBytes(data)
+        self.metrics["files"] += 1
+        return Comp.Image.fromFileSystem(self.spool.write(name, data))
+
+    def stats(self):
+        return dict(self.metrics, mode=self.mode, spool=self.spool.stats())
+
+# ================= 辅助类：SQLite 连接池 =================
+class SQLitePool:
+    """
+    长连接池：一个串行写连接 + 若干读连接 (WAL 模式下读写互不阻塞)
+    同时统计连接等待时间与忙重试次数，便于调整池大小
+    """
+    def __init__(self, db_path, readers=4, busy_timeout_ms=5000, max_busy_retries=5):
+        self.db_path = db_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.max_busy_retries = max_busy_retries
+        self._writer = self._connect()
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._conns = [self._writer]
+        for _ in range(max(1, readers)):
+            conn = self._connect()
+            self._readers.put(conn)
+            self._conns.append(conn)
+        self.reader_count = max(1, readers)
+        self._metrics_lock = threading.Lock()
+        self.metrics = {
+            "write_count": 0, "write_wait_ms": 0.0, "write_wait_max_ms": 0.0,
+            "read_count": 0, "read_wait_ms": 0.0, "read_wait_max_ms": 0.0,
+            "busy_retries": 0, "busy_failures": 0,
         }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    def _record_wait(self, kind, started):
+        wait_ms = (time.perf_counter() - started) * 1000
+        with self._metrics_lock:
+            self.metrics[f"{kind}_count"] += 1
+            self.metrics[f"{kind}_wait_ms"] += wait_ms
+            self.metrics[f"{kind}_wait_max_ms"] = max(self.metrics[f"{kind}_wait_max_ms"], wait_ms)
+
+    def _begin_immediate(self, c):
+        # 仅在获取写锁时可能遇到 SQLITE_BUSY (如外部进程持锁)，超出 busy_timeout 后退避重试
+        for attempt in range(self.max_busy_retries + 1):
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as e:
+                busy = "locked" in str(e) or "busy" in str(e)
+                if not busy or attempt == self.max_busy_retries:
+                    if busy:
+                        with self._metrics_lock: self.metrics["busy_failures"] += 1
+                    raise
+                with self._metrics_lock: self.metrics["busy_retries"] += 1
+                time.sleep(min(0.5, 0.02 * (2 ** attempt)))
+
+    @contextmanager
+    def transaction(self):
+        """写事务：正常退出提交，异常回滚"""
+        started = time.perf_counter()
+        with self._writer_lock:
+            self._record_wait("write", started)
+            conn = self._writer
+            c = conn.cursor()
+            self._begin_immediate(c)
+            try:
+                yield c
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        started = time.perf_counter()
+        conn = self._readers.get()
+        self._record_wait("read", started)
         try:
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req, timeout=15, context=self.ssl_context) as response:
-                data = response.read()
-                if len(data) < 100: return None
-                with open(file_path, "wb") as f: f.write(data)
-                return Image.open(BytesIO(data)).convert("RGBA")
-        except: return None
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    def stats(self):
+        with self._metrics_lock:
+            m = dict(self.metrics)
+        m["write_wait_avg_ms"] = m["write_wait_ms"] / m["write_count"] if m["write_count"] else 0.0
+        m["read_wait_avg_ms"] = m["read_wait_ms"] / m["read_count"] if m["read_count"] else 0.0
+        m["readers"] = self.reader_count
+        return m
+
+    def close(self):
+        for conn in self._conns:
+            try: conn.close()
+            except Exception: pass
+        self._conns = []
 
 # ================= 辅助类：数据库管理 =================
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, reader_pool_size=4):
         os.makedirs(PLUGIN_DIR, exist_ok=True)
         self.db_path = DB_FILE
+        self.pool = SQLitePool(self.db_path, readers=reader_pool_size)
         self._init_db()
 
-    def _get_conn(self):
-        return sqlite3.connect(self.db_path)
+    def close(self):
+        self.pool.close()
 
     def _init_db(self):
-        conn = self._get_conn()
-        c = conn.cursor()
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_key TEXT NOT NULL,
-                        name TEXT,
-                        quality TEXT,
-                        wear_value REAL,
-                        is_special INTEGER,
-                        img_url TEXT, 
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )''')
-        try:
-            c.execute("PRAGMA table_info(history)")
-            columns = [col[1] for col in c.fetchall()]
-            if 'img_url' not in columns: c.execute("ALTER TABLE history ADD COLUMN img_url TEXT")
-        except: pass
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_user_key ON history (user_key)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS user_stats (
-                        user_key TEXT NOT NULL,
-                        quality TEXT NOT NULL,
-                        count INTEGER DEFAULT 0,
-                        PRIMARY KEY (user_key, quality)
-                    )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS containers (
-                        name TEXT PRIMARY KEY,
-                        img_url TEXT,
-                        type TEXT
-                    )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS items (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        container_name TEXT,
-                        short_name TEXT,
-                        quality TEXT,
-                        img_url TEXT,
-                        FOREIGN KEY(container_name) REFERENCES containers(name)
-                    )''')
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_container ON items (container_name)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS open_limit_state (
-                        user_key TEXT NOT NULL,
-                        period_key TEXT NOT NULL,
-                        opened_count INTEGER NOT NULL DEFAULT 0,
-                        last_open_at TEXT NOT NULL,
-                        updated_at TEXT NOT NULL,
-                        PRIMARY KEY (user_key, period_key)
-                    )''')
-        c.execute('''CREATE INDEX IF NOT EXISTS idx_open_limit_user_period ON open_limit_state (user_key, period_key)''')
-        conn.commit()
-        conn.close()
-
-    def consume_daily_quota(self, user_key, period_key, request_count, daily_limit, now_text):
+        with self.pool.transaction() as c:
+            c.execute('''CREATE TABLE IF NOT EXISTS history (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_key TEXT NOT NULL,
+                            name TEXT,
+                            quality TEXT,
+                            wear_value REAL,
+                            is_special INTEGER,
+                            img_url TEXT, 
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )''')
+            try:
+                c.execute("PRAGMA table_info(history)")
+                columns = [col[1] for col in c.fetchall()]
+                if 'img_url' not in columns: c.execute("ALTER TABLE history ADD COLUMN img_url TEXT")
+            except: pass
+            # 覆盖索引：按用户倒序取最近稀有掉落无需回表
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_history_recent
+                         ON history (user_key, id, quality, is_special, name, wear_value, img_url)''')
+            c.execute("DROP INDEX IF EXISTS idx_user_key")
+            c.execute('''CREATE TABLE IF NOT EXISTS user_stats (
+                            user_key TEXT NOT NULL,
+                            quality TEXT NOT NULL,
+                            count INTEGER DEFAULT 0,
+                            PRIMARY KEY (user_key, quality)
+                        )''')
+            # 稀有品质计数聚合表，随 history 写入在同一事务内增量维护
+            c.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='rare_stats'")
+            has_rare_stats = c.fetchone()[0] > 0
+            c.execute('''CREATE TABLE IF NOT EXISTS rare_stats (
+                            user_key TEXT NOT NULL,
+                            quality TEXT NOT NULL,
+                            count INTEGER DEFAULT 0,
+                            PRIMARY KEY (user_key, quality)
+                        )''')
+            if not has_rare_stats:
+                c.execute("""
+                    INSERT INTO rare_stats (user_key, quality, count)
+                    SELECT user_key, quality, count(*) FROM history GROUP BY user_key, quality
+                """)
+            c.execute('''CREATE TABLE IF NOT EXISTS containers (
+                            name TEXT PRIMARY KEY,
+                            img_url TEXT,
+                            type TEXT
+                        )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS items (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            container_name TEXT,
+                            short_name TEXT,
+                            quality TEXT,
+                            img_url TEXT,
+                            FOREIGN KEY(container_name) REFERENCES containers(name)
+                        )''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_container ON items (container_name)''')
+            c.execute("PRAGMA table_info(containers)")
+            if 'content_hash' not in [col[1] for col in c.fetchall()]:
+                c.execute("ALTER TABLE containers ADD COLUMN content_hash TEXT")
+            c.execute('''CREATE TABLE IF NOT EXISTS catalog_meta (
+                            key TEXT PRIMARY KEY,
+                            value TEXT
+                        )''')
+            # 同步断点：已拉取完成的容器详情，中断后再次同步可跳过
+            c.execute('''CREATE TABLE IF NOT EXISTS sync_checkpoint (
+                            container_id TEXT PRIMARY KEY,
+                            name TEXT,
+                            img_url TEXT,
+                            items_json TEXT,
+                            fetched_at TEXT,
+                            list_hash TEXT
+                        )''')
+            c.execute("PRAGMA table_info(sync_checkpoint)")
+            if 'list_hash' not in [col[1] for col in c.fetchall()]:
+                c.execute("ALTER TABLE sync_checkpoint ADD COLUMN list_hash TEXT")
+            # 容器指纹：列表接口条目哈希 + 详情哈希，未变化的容器同步时跳过详情请求
+            c.execute('''CREATE TABLE IF NOT EXISTS container_fingerprints (
+                            container_id TEXT PRIMARY KEY,
+                            name TEXT,
+                            list_hash TEXT,
+                            detail_hash TEXT,
+                            item_count INTEGER,
+                            updated_field TEXT,
+                            checked_at TEXT
+                        )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS open_limit_state (
+                            user_key TEXT NOT NULL,
+                            period_key TEXT NOT NULL,
+                            opened_count INTEGER NOT NULL DEFAULT 0,
+                            last_open_at TEXT NOT NULL,
+                            updated_at TEXT NOT NULL,
+                            PRIMARY KEY (user_key, period_key)
+                        )''')
+            c.execute('''CREATE INDEX IF NOT EXISTS idx_open_limit_user_period ON open_limit_state (user_key, period_key)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS image_cache (
+                            file TEXT PRIMARY KEY,
+                            url TEXT,
+                            size INTEGER NOT NULL,
+                            last_access REAL NOT NULL
+                        )''')
+
+    def open_with_quota_tx(self, c, user_key, period_key, request_count, daily_limit, now_text, draw=None):
         """
-        每日额度检查区域
-        返回: (allowed_count, used_today, remaining_today)
+        额度扣减 + 开箱入库 (由写入线程在批量事务中调用，一起提交或回滚)
+        draw: 可选回调 draw(allowed_count) -> batch，batch 需包含 "rare" 与 "quality_counts"
+        返回: (allowed_count, used_today, remaining_today, batch)
         """
         if request_count <= 0:
             if daily_limit > 0:
-                return 0, 0, daily_limit
-            return 0, 0, -1
+                return 0, 0, daily_limit, None
+            return 0, 0, -1, None
 
-        conn = self._get_conn()
-        c = conn.cursor()
-        try:
-            c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            "SELECT opened_count FROM open_limit_state WHERE user_key=? AND period_key=?",
+            (user_key, period_key),
+        )
+        row = c.fetchone()
+        used_today = int(row[0]) if row else 0
+
+        if daily_limit > 0:
+            remaining = max(0, daily_limit - used_today)
+            allowed_count = min(request_count, remaining)
+        else:
+            allowed_count = request_count
+
+        new_used = used_today + allowed_count
+        if row:
             c.execute(
-                "SELECT opened_count FROM open_limit_state WHERE user_key=? AND period_key=?",
-                (user_key, period_key),
+                """
+                UPDATE open_limit_state
+                SET opened_count=?, last_open_at=?, updated_at=?
+                WHERE user_key=? AND period_key=?
+                """,
+                (new_used, now_text, now_text, user_key, period_key),
+            )
+        else:
+            c.execute(
+                """
+                INSERT INTO open_limit_state (user_key, period_key, opened_count, last_open_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (user_key, period_key, new_used, now_text, now_text),
             )
-            row = c.fetchone()
-            used_today = int(row[0]) if row else 0
 
-            if daily_limit > 0:
-                remaining = max(0, daily_limit - used_today)
-                allowed_count = min(request_count, remaining)
-            else:
-                allowed_count = request_count
-
-            new_used = used_today + allowed_count
-            if row:
-                c.execute(
-                    """
-                    UPDATE open_limit_state
-                    SET opened_count=?, last_open_at=?, updated_at=?
-                    WHERE user_key=? AND period_key=?
-                    """,
-                    (new_used, now_text, now_text, user_key, period_key),
-                )
-            else:
-                c.execute(
-                    """
-                    INSERT INTO open_limit_state (user_key, period_key, opened_count, last_open_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    (user_key, period_key, new_used, now_text, now_text),
-                )
-
-            conn.commit()
-            if daily_limit > 0:
-                remaining_today = max(0, daily_limit - new_used)
-            else:
-                remaining_today = -1
-            return allowed_count, new_used, remaining_today
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        batch = None
+        if draw and allowed_count > 0:
+            batch = draw(allowed_count)
+            self._write_items(c, user_key, batch["rare"], batch["quality_counts"])
+
+        if daily_limit > 0:
+            remaining_today = max(0, daily_limit - new_used)
+        else:
+            remaining_today = -1
+        return allowed_count, new_used, remaining_today, batch
 
     def migrate_json_history(self, item_img_map):
         if not os.path.exists(HISTORY_FILE): return
-        conn = self._get_conn()
-        c = conn.cursor()
-        c.execute("SELECT count(*) FROM user_stats")
-        has_stats = c.fetchone()[0] > 0
+        with self.pool.reader() as c:
+            c.execute("SELECT count(*) FROM user_stats")
+            has_stats = c.fetchone()[0] > 0
         if has_stats:
-            conn.close()
             return
 
         print("检测到旧版历史记录，正在迁移至数据库...")
@@ -309,142 +1061,584 @@ class DatabaseManager:
                     if count > 0:
                         stats_rows.append((uid, quality, count))
             
-            if history_rows:
-                c.executemany("INSERT INTO history (user_key, name, quality, wear_value, is_special, img_url) VALUES (?, ?, ?, ?, ?, ?)", history_rows)
-            if stats_rows:
-                c.executemany("INSERT OR REPLACE INTO user_stats (user_key, quality, count) VALUES (?, ?, ?)", stats_rows)
+            with self.pool.transaction() as c:
+                if history_rows:
+                    c.executemany("INSERT INTO history (user_key, name, quality, wear_value, is_special, img_url) VALUES (?, ?, ?, ?, ?, ?)", history_rows)
+                    self._add_rare_counts(c, history_rows)
+                if stats_rows:
+                    c.executemany("INSERT OR REPLACE INTO user_stats (user_key, quality, count) VALUES (?, ?, ?)", stats_rows)
             
-            conn.commit()
             print("历史记录迁移完成。")
             os.rename(HISTORY_FILE, HISTORY_FILE + ".bak")
         except Exception as e:
             print(f"历史迁移警告: {e}")
-        finally: conn.close()
 
     def migrate_cases(self):
         if not os.path.exists(CASES_FILE): return
-        conn = self._get_conn()
-        c = conn.cursor()
-        c.execute("SELECT count(*) FROM containers")
-        if c.fetchone()[0] > 0:
-            conn.close()
-            return
+        with self.pool.reader() as c:
+            c.execute("SELECT count(*) FROM containers")
+            if c.fetchone()[0] > 0:
+                return
         try:
             with open(CASES_FILE, 'r', encoding='utf-8') as f: cases = json.load(f)
             case_imgs = {}
             if os.path.exists(IMAGES_MAP_FILE):
                 with open(IMAGES_MAP_FILE, 'r', encoding='utf-8') as f: case_imgs = json.load(f)
-            for name, items in cases.items():
-                img = case_imgs.get(name, "")
-                c.execute("INSERT OR REPLACE INTO containers (name, img_url) VALUES (?, ?)", (name, img))
-                rows = []
-                for item in items:
-                    rows.append((name, item.get("short_name"), item.get("rln"), item.get("img")))
-                c.executemany("INSERT INTO items (container_name, short_name, quality, img_url) VALUES (?, ?, ?, ?)", rows)
-            conn.commit()
+            with self.pool.transaction() as c:
+                for name, items in cases.items():
+                    img = case_imgs.get(name, "")
+                    c.execute("INSERT OR REPLACE INTO containers (name, img_url) VALUES (?, ?)", (name, img))
+                    rows = []
+                    for item in items:
+                        rows.append((name, item.get("short_name"), item.get("rln"), item.get("img")))
+                    c.executemany("INSERT INTO items (container_name, short_name, quality, img_url) VALUES (?, ?, ?, ?)", rows)
             os.rename(CASES_FILE, CASES_FILE + ".bak")
             if os.path.exists(IMAGES_MAP_FILE): os.rename(IMAGES_MAP_FILE, IMAGES_MAP_FILE + ".bak")
         except Exception as e: pass
-        finally: conn.close()
 
-    def save_all_data(self, new_cases, new_imgs):
-        conn = self._get_conn()
-        c = conn.cursor()
-        try:
-            c.execute("DELETE FROM items")
-            c.execute("DELETE FROM containers")
-            for name, items in new_cases.items():
-                img = new_imgs.get(name, "")
-                c.execute("INSERT INTO containers (name, img_url) VALUES (?, ?)", (name, img))
-                rows = []
-                for item in items:
-                    rows.append((name, item.get("short_name"), item.get("rln"), item.get("img")))
-                c.executemany("INSERT INTO items (container_name, short_name, quality, img_url) VALUES (?, ?, ?, ?)", rows)
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"保存失败: {e}")
-            return False
-        finally: conn.close()
-
-    def load_all_data(self):
-        conn = self._get_conn()
-        c = conn.cursor()
-        c.execute("SELECT name, img_url FROM containers")
-        images_map = {row[0]: row[1] for row in c.fetchall()}
-        case_data = {}
-        c.execute("SELECT container_name, short_name, quality, img_url FROM items")
-        for row in c.fetchall():
-            c_name, s_name, q, img = row
-            if c_name not in case_data: case_data[c_name] = []
-            case_data[c_name].append({"short_name": s_name, "rln": q, "img": img})
-        item_img_map = {}
-        c.execute("SELECT short_name, img_url FROM items WHERE img_url IS NOT NULL")
-        for row in c.fetchall(): item_img_map[row[0]] = row[1]
-        conn.close()
-        return case_data, images_map, item_img_map
-
-    def add_item(self, user_key, item):
-        conn = self._get_conn()
-        c = conn.cursor()
-        quality = item['quality']
-        is_rare = quality in ["隐秘", "非凡", "Contraband"] or item.get('is_special', False)
-        if is_rare:
-            c.execute("INSERT INTO history (user_key, name, quality, wear_value, is_special, img_url) VALUES (?, ?, ?, ?, ?, ?)",
-                      (user_key, item['name'], quality, item['wear_value'], 1, item.get('img', '')))
-        else:
+    @staticmethod
+    def container_hash(img_url, items):
+        payload = [img_url or "", [(i.get("short_name"), i.get("rln"), i.get("img")) for i in items]]
+        return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def sync_catalog_tx(self, c, new_cases, new_imgs):
+        """
+        差量同步武器箱目录：按容器内容哈希只写入新增/变更的容器，删除已下架容器 (由写入线程在事务中调用)
+        返回: {"inserted", "changed", "removed", "unchanged", "version", "hashes"}
+        """
+        c.execute("SELECT name, img_url, content_hash FROM containers")
+        old = {row[0]: (row[1], row[2]) for row in c.fetchall()}
+        # 旧版本数据没有哈希，按库内现有物品补算，避免首次差量同步误判为全部变更
+        missing = [name for name, (_, h) in old.items() if not h]
+        if missing:
+            stored = {}
+            c.execute("SELECT container_name, short_name, quality, img_url FROM items ORDER BY id")
+            for c_name, s_name, q, img in c.fetchall():
+                stored.setdefault(c_name, []).append({"short_name": s_name, "rln": q, "img": img})
+            for name in missing:
+                old[name] = (old[name][0], self.container_hash(old[name][0], stored.get(name, [])))
+
+        hashes = {}
+        result = {"inserted": [], "changed": [], "removed": [], "unchanged": 0}
+        for name, items in new_cases.items():
+            img = new_imgs.get(name, "")
+            h = self.container_hash(img, items)
+            hashes[name] = h
+            if name in old and old[name][1] == h:
+                result["unchanged"] += 1
+                continue
+            if name in old:
+                result["changed"].append(name)
+                c.execute("DELETE FROM items WHERE container_name=?", (name,))
+                c.execute("UPDATE containers SET img_url=?, content_hash=? WHERE name=?", (img, h, name))
+            else:
+                result["inserted"].append(name)
+                c.execute("INSERT INTO containers (name, img_url, content_hash) VALUES (?, ?, ?)", (name, img, h))
+            rows = [(name, item.get("short_name"), item.get("rln"), item.get("img")) for item in items]
+            c.executemany("INSERT INTO items (container_name, short_name, quality, img_url) VALUES (?, ?, ?, ?)", rows)
+        for name in old:
+            if name not in new_cases:
+                result["removed"].append(name)
+                c.execute("DELETE FROM items WHERE container_name=?", (name,))
+                c.execute("DELETE FROM containers WHERE name=?", (name,))
+        for name in missing:
+            if name in hashes and name not in result["changed"]:
+                c.execute("UPDATE containers SET content_hash=? WHERE name=?", (hashes[name], name))
+
+        version = self._catalog_version(c)
+        if result["inserted"] or result["changed"] or result["removed"]:
+            version += 1
+            c.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('version', ?)", (str(version),))
+        result["version"] = version
+        result["hashes"] = hashes
+        return result
+
+    def _catalog_version(self, c):
+        c.execute("SELECT value FROM catalog_meta WHERE key='version'")
+        row = c.fetchone()
+        return int(row[0]) if row else 0
+
+    def load_sync_checkpoint(self, max_age_hours=24):
+        """
+        读取未完成同步的断点；超过 max_age_hours 的旧断点视为过期
+        返回: {container_id: (name, img_url, items, list_hash)}，无可用断点时返回 {}
+        """
+        with self.pool.reader() as c:
+            c.execute("SELECT value FROM catalog_meta WHERE key='sync_started_at'")
+            row = c.fetchone()
+            if not row or time.time() - float(row[0]) > max_age_hours * 3600:
+                return {}
+            c.execute("SELECT container_id, name, img_url, items_json, list_hash FROM sync_checkpoint")
+            return {r[0]: (r[1], r[2], json.loads(r[3]), r[4]) for r in c.fetchall()}
+
+    def begin_sync_tx(self, c, resume):
+        if not resume:
+            c.execute("DELETE FROM sync_checkpoint")
+            c.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('sync_started_at', ?)", (str(time.time()),))
+
+    def save_sync_checkpoint_tx(self, c, container_id, name, img_url, items, list_hash):
+        c.execute("INSERT OR REPLACE INTO sync_checkpoint (container_id, name, img_url, items_json, fetched_at, list_hash) VALUES (?, ?, ?, ?, ?, ?)",
+                  (str(container_id), name, img_url, json.dumps(items, ensure_ascii=False), datetime.now().strftime("%Y-%m-%d %H:%M:%S"), list_hash))
+
+    def load_fingerprints(self):
+        """返回 {container_id: {"name", "list_hash", "detail_hash", "item_count", "updated_field"}}"""
+        with self.pool.reader() as c:
+            c.execute("SELECT container_id, name, list_hash, detail_hash, item_count, updated_field FROM container_fingerprints")
+            return {r[0]: {"name": r[1], "list_hash": r[2], "detail_hash": r[3], "item_count": r[4], "updated_field": r[5]}
+                    for r in c.fetchall()}
+
+    def finish_sync_tx(self, c, fingerprints):
+        """同步成功后清理断点，并以本次列表为准整体替换容器指纹"""
+        c.execute("DELETE FROM sync_checkpoint")
+        c.execute("DELETE FROM catalog_meta WHERE key='sync_started_at'")
+        c.execute("DELETE FROM container_fingerprints")
+        now_text = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        c.executemany("""
+            INSERT INTO container_fingerprints (container_id, name, list_hash, detail_hash, item_count, updated_field, checked_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(cid, f["name"], f["list_hash"], f["detail_hash"], f["item_count"], f["updated_field"], now_text)
+              for cid, f in fingerprints.items()])
+
+    def load_image_index(self):
+        """返回图片磁盘缓存索引 [(file, url, size, last_access)]"""
+        with self.pool.reader() as c:
+            c.execute("SELECT file, url, size, last_access FROM image_cache")
+            return c.fetchall()
+
+    @staticmethod
+    def save_image_index_tx(c, upserts, removed):
+        if removed:
+            c.executemany("DELETE FROM image_cache WHERE file = ?", [(f,) for f in removed])
+        if upserts:
+            c.executemany("INSERT OR REPLACE INTO image_cache (file, url, size, last_access) VALUES (?, ?, ?, ?)", upserts)
+
+    def load_catalog(self):
+        """返回 (version, case_data, images_map, hashes)"""
+        with self.pool.reader() as c:
+            version = self._catalog_version(c)
+            c.execute("SELECT name, img_url, content_hash FROM containers")
+            rows = c.fetchall()
+            images_map = {row[0]: row[1] for row in rows}
+            hashes = {row[0]: row[2] for row in rows}
+            case_data = {}
+            c.execute("SELECT container_name, short_name, quality, img_url FROM items ORDER BY id")
+            for row in c.fetchall():
+                c_name, s_name, q, img = row
+                if c_name not in case_data: case_data[c_name] = []
+                case_data[c_name].append({"short_name": s_name, "rln": q, "img": img})
+        for name, items in case_data.items():
+            if not hashes.get(name):
+                hashes[name] = self.container_hash(images_map.get(name, ""), items)
+        return version, case_data, images_map, hashes
+
+    def _write_items(self, c, user_key, items, quality_counts=None):
+        history_rows = []
+        counts = {}
+        for item in items:
+            quality = item['quality']
+            if quality in RARE_QUALITIES or item.get('is_special', False):
+                history_rows.append((user_key, item['name'], quality, item['wear_value'], 1, item.get('img', '')))
+            elif quality_counts is None:
+                counts[quality] = counts.get(quality, 0) + 1
+        if quality_counts is not None:
+            counts = {q: n for q, n in quality_counts.items() if q not in RARE_QUALITIES}
+
+        if history_rows:
+            c.executemany("INSERT INTO history (user_key, name, quality, wear_value, is_special, img_url) VALUES (?, ?, ?, ?, ?, ?)",
+                          history_rows)
+            self._add_rare_counts(c, history_rows)
+        stats_rows = [(user_key, q, n) for q, n in counts.items() if n > 0]
+        if stats_rows:
+            c.executemany("""
+                INSERT INTO user_stats (user_key, quality, count) VALUES (?, ?, ?)
+                ON CONFLICT(user_key, quality) DO UPDATE SET count = count + excluded.count
+            """, stats_rows)
+
+    def _add_rare_counts(self, c, history_rows):
+        counts = {}
+        for row in history_rows:
+            key = (row[0], row[2])
+            counts[key] = counts.get(key, 0) + 1
+        c.executemany("""
+            INSERT INTO rare_stats (user_key, quality, count) VALUES (?, ?, ?)
+            ON CONFLICT(user_key, quality) DO UPDATE SET count = count + excluded.count
+        """, [(u, q, n) for (u, q), n in counts.items()])
+
+    def get_user_total(self, user_key):
+        with self.pool.reader() as c:
             c.execute("""
-                INSERT INTO user_stats (user_key, quality, count) VALUES (?, ?, 1)
-                ON CONFLICT(user_key, quality) DO UPDATE SET count = count + 1
-            """, (user_key, quality))
-        conn.commit()
-        conn.close()
+                SELECT (SELECT COALESCE(SUM(count), 0) FROM user_stats WHERE user_key=?)
+                     + (SELECT COALESCE(SUM(count), 0) FROM rare_stats WHERE user_key=?)
+            """, (user_key, user_key))
+            return c.fetchone()[0]
 
     def get_user_stats(self, user_key):
-        conn = self._get_conn()
-        c = conn.cursor()
-        c.execute("SELECT quality, count FROM user_stats WHERE user_key=?", (user_key,))
-        stats = dict(c.fetchall())
-        c.execute("SELECT quality, count(*) FROM history WHERE user_key=? GROUP BY quality", (user_key,))
-        rare_stats = dict(c.fetchall())
-        for q, count in rare_stats.items():
-            stats[q] = stats.get(q, 0) + count
-        total = sum(stats.values())
-        c.execute("""
-            SELECT name, quality, wear_value, img_url
-            FROM history 
-            WHERE user_key=? 
-            AND (quality IN ('隐秘', '非凡', 'Contraband') OR is_special=1) 
-            ORDER BY id DESC LIMIT 10
-        """, (user_key,))
-        rare_items = []
-        for row in c.fetchall():
-            rare_items.append({"name": row[0], "quality": row[1], "wear_value": row[2], "img_url": row[3]})
-        conn.close()
+        with self.pool.reader() as c:
+            c.execute("SELECT quality, count FROM user_stats WHERE user_key=?", (user_key,))
+            stats = dict(c.fetchall())
+            c.execute("SELECT quality, count FROM rare_stats WHERE user_key=?", (user_key,))
+            for q, count in c.fetchall():
+                stats[q] = stats.get(q, 0) + count
+            total = sum(stats.values())
+            c.execute("""
+                SELECT name, quality, wear_value, img_url
+                FROM history 
+                WHERE user_key=? 
+                AND (quality IN ('隐秘', '非凡', 'Contraband') OR is_special=1) 
+                ORDER BY id DESC LIMIT 10
+            """, (user_key,))
+            rare_items = []
+            for row in c.fetchall():
+                rare_items.append({"name": row[0], "quality": row[1], "wear_value": row[2], "img_url": row[3]})
         return {"total": total, "other_stats": stats, "items": rare_items}
 
-    def clear_user_history(self, user_key):
-        conn = self._get_conn()
-        c = conn.cursor()
+    def clear_user_history_tx(self, c, user_key):
         c.execute("DELETE FROM history WHERE user_key=?", (user_key,))
         c.execute("DELETE FROM user_stats WHERE user_key=?", (user_key,))
-        conn.commit()
-        conn.close()
+        c.execute("DELETE FROM rare_stats WHERE user_key=?", (user_key,))
+
+# ================= 辅助类：数据库写入线程 =================
+class DBWriter:
+    """
+    独立写入线程：事件循环只投递任务并 await 结果，不在循环内执行 SQLite 写操作
+    取到任务后把队列中已在等待的任务 (最多 max_batch 个) 一并取出合并为一次事务提交，
+    队列为空时立即提交，不额外等待；繁忙时上一批提交期间到达的任务自然进入下一批
+    每个任务使用独立 SAVEPOINT，单个任务失败不影响同批其他任务
+    """
+    def __init__(self, db, max_batch=64):
+        self.db = db
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._stopped = False
+        self.metrics = {"jobs": 0, "batches": 0, "max_batch_seen": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="case-db-writer", daemon=True)
+        self._thread.start()
+
+    async def submit(self, fn, *args):
+        """在写入线程的事务中执行 fn(cursor, *args)，返回其结果"""
+        if self._stopped:
+            raise RuntimeError("数据库写入线程已停止")
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((fn, args, loop, fut))
+        return await fut
+
+    def _collect(self):
+        job = self._queue.get()
+        if job is None: return None
+        jobs = [job]
+        while len(jobs) < self.max_batch:
+            try:
+                nxt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if nxt is None:
+                self._queue.put(None)
+                break
+            jobs.append(nxt)
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            if jobs is None: break
+            results = []
+            try:
+                with self.db.pool.transaction() as c:
+                    for idx, (fn, args, _, _) in enumerate(jobs):
+                        c.execute(f"SAVEPOINT job_{idx}")
+                        try:
+                            results.append((True, fn(c, *args)))
+                            c.execute(f"RELEASE job_{idx}")
+                        except Exception as e:
+                            c.execute(f"ROLLBACK TO job_{idx}")
+                            c.execute(f"RELEASE job_{idx}")
+                            results.append((False, e))
+            except Exception as e:
+                results = [(False, e)] * len(jobs)
+            self.metrics["jobs"] += len(jobs)
+            self.metrics["batches"] += 1
+            self.metrics["max_batch_seen"] = max(self.metrics["max_batch_seen"], len(jobs))
+            for (_, _, loop, fut), (ok, value) in zip(jobs, results):
+                if not ok: self.metrics["failed"] += 1
+                try:
+                    loop.call_soon_threadsafe(self._resolve, fut, ok, value)
+                except RuntimeError:
+                    pass  # 事件循环已关闭
+
+    @staticmethod
+    def _resolve(fut, ok, value):
+        if fut.done(): return
+        if ok: fut.set_result(value)
+        else: fut.set_exception(value)
+
+    async def stop(self):
+        """停止接收新任务，等待队列中已投递的任务全部提交"""
+        if self._stopped: return
+        self._stopped = True
+        self._queue.put(None)
+        await asyncio.to_thread(self._thread.join)
+
+# ================= 辅助类：武器箱数据快照 =================
+class CatalogSnapshot:
+    """
+    某一目录版本下的武器箱数据与抽样器；同步时整体替换引用，
+    进行中的开箱持有旧快照继续使用，不受同步影响
+    """
+    def __init__(self, version, case_data, case_images, hashes, samplers, batch_tables=None):
+        self.version = version
+        self.case_data = case_data
+        self.case_images = case_images
+        self.hashes = hashes
+        self.samplers = samplers
+        self.batch_tables = batch_tables or {}
+        # 随快照失效的预渲染内容：武器箱列表文本、缩放后的封面 PNG 等
+        self.assets = {}
+        self.item_img_map = {}
+        for items in case_data.values():
+            for item in items:
+                if item.get("img"): self.item_img_map[item["short_name"]] = item["img"]
 
 # ================= 辅助类：GIF/图片 生成器 =================
+class ThumbnailAtlas:
+    """
+    单个容器的条带缩略图图集：每个 (图片, 品质) 一格，品质色条已预先绘制
+    格子纵向排列在一张 RGBA 图中，磁盘上以 zlib 压缩的像素保存 (透明边距几乎不占空间)
+    """
+    def __init__(self, tile_w, tile_h, keys, image, complete=True, key=None):
+        self.tile_w = tile_w
+        self.tile_h = tile_h
+        self.index = {tuple(k): i for i, k in enumerate(keys)}
+        self.image = image
+        self.complete = complete
+        # 已落盘图集的内容哈希，渲染进程可凭此从磁盘载入
+        self.key = key
+        self.palette = None
+
+    def has(self, key):
+        return key in self.index
+
+    def tile(self, key):
+        i = self.index.get(key)
+        if i is None: return None
+        return self.image.crop((0, i * self.tile_h, self.tile_w, (i + 1) * self.tile_h))
+
+class AtlasStore:
+    """
+    按容器内容哈希管理缩略图图集：内存 → 磁盘 → 现场生成
+    容器物品变化后哈希随之改变，旧图集在同步后清理；缺图的图集只用于本次渲染，不落盘
+    图集文件与图片缓存放在同一目录并登记到磁盘缓存索引，计入容量上限、按 LRU 淘汰，随“清除缓存”删除
+    """
+    MAX_IN_MEMORY = 32
+    FORMAT_VERSION = 2
+    MAGIC = b"ATL2"
+
+    def __init__(self, image_manager, item_size, bar_h, directory=IMAGES_DIR):
+        self.img_mgr = image_manager
+        self.item_size = item_size
+        self.bar_h = bar_h
+        # 与条带中色条 (含边界像素) + 缩略图占用的区域一致
+        self.tile_w = item_size + 1
+        self.tile_h = item_size + bar_h + 1
+        self.directory = directory
+        self._atlases = OrderedDict()
+        self._inflight = {}
+        self.metrics = {"hits": 0, "loaded": 0, "built": 0, "incomplete": 0, "bytes_written": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._remove_legacy()
+
+    @staticmethod
+    def tile_key(item):
+        return (item.get("img") or "", item.get("rln") or "")
+
+    def _path(self, content_hash):
+        return os.path.join(self.directory, f"atlas_{content_hash}.bin")
+
+    @staticmethod
+    def _remove_legacy():
+        """删除旧版未压缩图集 (原始 RGBA + JSON)"""
+        try:
+            names = os.listdir(LEGACY_ATLAS_DIR)
+        except OSError:
+            return
+        for name in names:
+            try: os.remove(os.path.join(LEGACY_ATLAS_DIR, name))
+            except OSError: pass
+        try: os.rmdir(LEGACY_ATLAS_DIR)
+        except OSError: pass
+
+    async def get(self, content_hash, case_items):
+        """取容器图集；content_hash 为空时只生成临时图集"""
+        if not content_hash:
+            return await self._build(case_items)
+        atlas = self._atlases.get(content_hash)
+        if atlas is not None:
+            self._atlases.move_to_end(content_hash)
+            self.metrics["hits"] += 1
+            self.img_mgr.track_file(self._path(content_hash))
+            return atlas
+        task = self._inflight.get(content_hash)
+        if task is None:
+            task = asyncio.ensure_future(self._load_or_build(content_hash, case_items))
+            self._inflight[content_hash] = task
+            task.add_done_callback(lambda _: self._inflight.pop(content_hash, None))
+        return await asyncio.shield(task)
+
+    async def _load_or_build(self, content_hash, case_items):
+        atlas = await asyncio.to_thread(self._load, content_hash)
+        if atlas is not None:
+            self.metrics["loaded"] += 1
+            self.img_mgr.track_file(self._path(content_hash))
+        else:
+            atlas = await self._build(case_items)
+            if not atlas.complete: return atlas
+            try:
+                size = await asyncio.to_thread(self._save, content_hash, atlas)
+                atlas.key = content_hash
+                self.metrics["bytes_written"] += size
+                self.img_mgr.track_file(self._path(content_hash), size)
+            except Exception as e:
+                print(f"图集保存失败: {e}")
+        self._remember(content_hash, atlas)
+        return atlas
+
+    def _remember(self, content_hash, atlas):
+        self._atlases[content_hash] = atlas
+        while len(self._atlases) > self.MAX_IN_MEMORY:
+            self._atlases.popitem(last=False)
+
+    def load_cached(self, content_hash):
+        """只从内存或磁盘取已落盘的图集，不生成；供渲染进程使用"""
+        atlas = self._atlases.get(content_hash)
+        if atlas is None:
+            atlas = self._load(content_hash)
+            if atlas is None: return None
+            self._remember(content_hash, atlas)
+        return atlas
+
+    async def _build(self, case_items):
+        keys = list(dict.fromkeys(self.tile_key(i) for i in case_items))
+        images = await asyncio.gather(*[self.img_mgr.get_image(url) for url, _ in keys])
+        atlas = await asyncio.to_thread(self._compose, keys, images)
+        self.metrics["built"] += 1
+        if not atlas.complete: self.metrics["incomplete"] += 1
+        return atlas
+
+    def _compose(self, keys, images):
+        sheet = Image.new("RGBA", (self.tile_w, self.tile_h * max(1, len(keys))), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(sheet)
+        complete = True
+        for i, ((url, rln), img) in enumerate(zip(keys, images)):
+            y = i * self.tile_h
+            q_color = QUALITY_COLORS.get(rln, (100, 100, 100))
+            draw.rectangle([0, y + self.item_size, self.item_size, y + self.item_size + self.bar_h], fill=q_color)
+            thumb = self.img_mgr.thumbnail(url, img, (self.item_size, self.item_size))
+            if thumb:
+                sheet.paste(thumb, (0, y), thumb)
+            else:
+                complete = False
+        return ThumbnailAtlas(self.tile_w, self.tile_h, keys, sheet, complete)
+
+    def _save(self, content_hash, atlas):
+        """写入 魔数 + 元数据长度 + 元数据 JSON + zlib 压缩像素，返回文件大小"""
+        meta = json.dumps({"version": self.FORMAT_VERSION, "tile_w": atlas.tile_w, "tile_h": atlas.tile_h,
+                           "keys": [list(k) for k in atlas.index]}, ensure_ascii=False).encode("utf-8")
+        data = b"".join((self.MAGIC, len(meta).to_bytes(4, "big"), meta, zlib.compress(atlas.image.tobytes(), 6)))
+        path = self._path(content_hash)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f: f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        return len(data)
+
+    def _load(self, content_hash):
+        try:
+            with open(self._path(content_hash), "rb") as f:
+                data = f.read()
+            if data[:4] != self.MAGIC: return None
+            meta_len = int.from_bytes(data[4:8], "big")
+            meta = json.loads(data[8:8 + meta_len].decode("utf-8"))
+            if meta.get("version") != self.FORMAT_VERSION or meta["tile_w"] != self.tile_w or meta["tile_h"] != self.tile_h:
+                return None
+            keys = meta["keys"]
+            size = (self.tile_w, self.tile_h * max(1, len(keys)))
+            raw = zlib.decompress(data[8 + meta_len:])
+            if len(raw) != size[0] * size[1] * 4: return None
+            image = Image.frombytes("RGBA", size, raw)
+            return ThumbnailAtlas(self.tile_w, self.tile_h, keys, image, key=content_hash)
+        except Exception:
+            return None
+
+    def prune(self, valid_hashes):
+        """删除已不属于当前目录的图集文件 (在事件循环线程调用，同步更新磁盘缓存索引)"""
+        valid = set(valid_hashes)
+        for h in [h for h in self._atlases if h not in valid]:
+            del self._atlases[h]
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        stale = [n for n in names
+                 if n.startswith("atlas_") and n.endswith(".bin") and n[len("atlas_"):-len(".bin")] not in valid]
+        if stale: self.img_mgr.discard(stale)
+
+    def clear(self):
+        self._atlases.clear()
+
+    def stats(self):
+        return dict(self.metrics, in_memory=len(self._atlases))
+
 class GifGenerator:
-    def __init__(self, image_manager):
+    TEMPLATE_VARIANTS = 3   # 每个容器的填充条带数
+    TEMPLATE_OFFSETS = 6    # 停止位置的档位数
+    WEBP_QUALITY = 75
+    PROFILE_EWMA_ALPHA = 0.2   # 档位体积指数加权平均的新样本权重
+    PROFILE_STALE_S = 600      # 档位超过该时长没有新样本时，旧的平均体积视为过期
+    # 输出档位：视口宽度、帧率、滚动时长 (秒)、结尾放大帧数、结尾停留帧数；fallback 为超出预算时的降级档位
+    PROFILES = {
+        "full": {"label": "完整", "format": "gif", "ext": "gif", "width": 800, "fps": 20, "scroll": 3.5,
+                 "outro": 20, "hold": 20, "fallback": "compact"},
+        "compact": {"label": "精简", "format": "gif", "ext": "gif", "width": 560, "fps": 12, "scroll": 2.5,
+                    "outro": 8, "hold": 12, "fallback": "static"},
+        "webp": {"label": "WebP", "format": "webp", "ext": "webp", "width": 800, "fps": 20, "scroll": 3.5,
+                 "outro": 20, "hold": 20, "fallback": "compact"},
+        "static": {"label": "静态", "format": "png", "ext": "png", "width": 800, "fps": 20, "scroll": 3.5,
+                   "outro": 20, "hold": 20, "fallback": None},
+    }
+
+    @classmethod
+    def available_profiles(cls):
+        return [name for name, spec in cls.PROFILES.items() if spec["format"] != "webp" or WEBP_SUPPORTED]
+
+    def __init__(self, image_manager, fast_encoder=True, render_pool=None, template_cache_bytes=0):
         self.img_mgr = image_manager
+        self.fast_encoder = fast_encoder
+        self.render_pool = render_pool
+        # 动画模板：按 (图集, 填充条带, 停止档位) 缓存已编码的前段帧与中奖格附近的量化条带
+        self.templates = DecodedImageCache(template_cache_bytes) if template_cache_bytes > 0 and fast_encoder else None
+        self._template_inflight = {}
+        self.template_metrics = {"built": 0, "build_ms": 0.0, "fallbacks": 0}
+        self._help_card = None
+        self.COLLAGE_COLUMNS = 5
+        self.COLLAGE_MAX_TILES = 30
         self.BASE_ITEM_SIZE = 200   
         self.MAX_ITEM_SIZE = 260    
         self.MARGIN = 20            
-        self.VIEWPORT_W = 800       
         self.VIEWPORT_H = 350       
         self.TOTAL_ITEMS = 35       
         self.WINNER_INDEX = 28      
         self.HEAD_BUFFER = 8        
-        self.FPS = 20               
-        self.SCROLL_DURATION = 3.5  
+        self.BAR_H = 6
+        self.BG_COLOR = (30, 30, 35, 255)
+        self._apply_profile("full")
+        self._variants = {"full": self}
+        self.metrics = {mode: {"renders": 0, "compose_ms": 0.0, "encode_ms": 0.0, "bytes": 0}
+                        for mode in ("fast", "legacy", "template", "webp", "static")}
+        self.profile_metrics = {name: {"renders": 0, "render_ms": 0.0, "bytes": 0, "max_bytes": 0, "avg_bytes": 0.0, "last": 0.0}
+                                for name in self.PROFILES}
+        self.atlas_store = AtlasStore(image_manager, self.BASE_ITEM_SIZE, self.BAR_H)
         
         try:
             self.font = ImageFont.truetype("msyh.ttc", 16)
@@ -455,7 +1649,34 @@ class GifGenerator:
             self.font_bold = self.font
             self.font_title = self.font
 
-    async def generate(self, winner_item, case_items, case_img_url=None):
+    def _apply_profile(self, name):
+        spec = self.PROFILES[name]
+        self.profile = name
+        self.output_format = spec["format"]
+        self.VIEWPORT_W = spec["width"]
+        self.FPS = spec["fps"]
+        self.SCROLL_DURATION = spec["scroll"]
+        self.OUTRO_FRAMES = spec["outro"]
+        self.HOLD_FRAMES = spec["hold"]
+
+    def variant(self, name):
+        """取指定输出档位的生成器，与本实例共享图集、模板缓存和统计"""
+        gen = self._variants.get(name)
+        if gen is None:
+            gen = copy.copy(self)
+            gen._apply_profile(name)
+            self._variants[name] = gen
+        return gen
+
+    async def generate(self, winner_item, case_items, case_img_url=None, atlas_key=None, profile="full", record=True):
+        if profile != self.profile:
+            return await self.variant(profile).generate(winner_item, case_items, case_img_url, atlas_key, profile, record)
+        if self.output_format == "png":
+            winner_img = await self.img_mgr.get_image(winner_item.get("img"))
+            data, compose_s, encode_s = await asyncio.to_thread(self._create_static, winner_item, winner_img)
+            self._record_render("static", compose_s, encode_s, len(data), record)
+            return data
+
         filler_pool = [i for i in case_items if i.get("rln") != "非凡"]
         if not filler_pool: filler_pool = case_items
 
@@ -468,114 +1689,431 @@ class GifGenerator:
         for _ in range(self.TOTAL_ITEMS - self.WINNER_INDEX - 1):
             scroll_items.append(random.choice(filler_pool))
 
-        img_tasks = [self.img_mgr.get_image(item.get("img")) for item in scroll_items]
-        item_images = await asyncio.gather(*img_tasks)
-
-        return await asyncio.to_thread(self._create_optimized_gif, scroll_items, item_images)
+        atlas = await self.atlas_store.get(atlas_key, case_items)
+        winner_img = await self.img_mgr.get_image(winner_item.get("img"))
+        if self.templates is not None and self.output_format == "gif" and atlas.key and atlas.has(AtlasStore.tile_key(winner_item)):
+            data = await self._generate_from_template(winner_item, winner_img, filler_pool, atlas, record)
+            if data is not None: return data
+        if not all(atlas.has(AtlasStore.tile_key(i)) for i in scroll_items):
+            atlas = await self.atlas_store.get(None, scroll_items)
+        random_offset = random.uniform(-0.4, 0.4) * self.BASE_ITEM_SIZE
 
-    def _create_optimized_gif(self, items_data, images):
+        result = None
+        if self.render_pool is not None and atlas.key:
+            # 渲染进程凭图集哈希与图片 URL 从磁盘缓存取图，只传递精简的任务描述
+            job = {
+                "atlas_key": atlas.key,
+                "items": [{"img": i.get("img"), "rln": i.get("rln")} for i in scroll_items],
+                "winner": {"img": winner_item.get("img"), "rln": winner_item.get("rln"), "name": winner_item.get("name", "???")},
+                "has_winner_img": winner_img is not None,
+                "offset": random_offset,
+                "profile": self.profile,
+            }
+            job["items"][self.WINNER_INDEX + self.HEAD_BUFFER] = job["winner"]
+            result = await self.render_pool.run(_render_gif_job, job)
+        if result is None:
+            result = await asyncio.to_thread(self._render_gif, scroll_items, atlas, winner_img, random_offset)
+        data, mode, compose_s, encode_s = result
+        self._record_render(mode, compose_s, encode_s, len(data), record)
+        return data
+
+    def _render_gif(self, items_data, atlas, winner_img, random_offset):
+        """返回 (动图数据, 编码方式, 合成耗时, 编码耗时)"""
+        if self.output_format == "webp":
+            render = self._create_webp
+        else:
+            render = self._create_fast_gif if self.fast_encoder else self._create_optimized_gif
+        return render(items_data, atlas, winner_img, random_offset)
+
+    def render_gif_job(self, job):
+        """渲染进程内执行：图集或中奖图片缺失时返回 None，由主进程改走线程渲染"""
+        atlas = self.atlas_store.load_cached(job["atlas_key"])
+        if atlas is None: return None
+        winner_img = self.img_mgr.load_cached(job["winner"]["img"])
+        if job["has_winner_img"] and winner_img is None: return None
+        return self._render_gif(job["items"], atlas, winner_img, job["offset"])
+
+    def _build_strip(self, items_data, atlas):
+        unit_w = self.BASE_ITEM_SIZE + self.MARGIN
+        strip_img = Image.new("RGBA", (len(items_data) * unit_w, self.VIEWPORT_H), (0,0,0,0))
+        draw_y = (self.VIEWPORT_H - self.BASE_ITEM_SIZE) // 2 - 20
+        # 格子互不重叠，直接整块拷贝图集中的区域；None 表示留空的格子
+        for idx, item_data in enumerate(items_data):
+            if item_data is None: continue
+            strip_img.paste(atlas.tile(AtlasStore.tile_key(item_data)), (idx * unit_w, draw_y))
+        return strip_img
+
+    def _scroll_offsets(self, strip_width, random_offset):
+        """每个滚动帧的条带裁剪起点 (缓出减速，停在中奖格附近的随机位置)"""
         unit_w = self.BASE_ITEM_SIZE + self.MARGIN
-        total_width = len(items_data) * unit_w
-        
-        strip_img = Image.new("RGBA", (total_width, self.VIEWPORT_H), (0,0,0,0))
-        strip_draw = ImageDraw.Draw(strip_img)
-        
-        for idx, (item_data, img) in enumerate(zip(items_data, images)):
-            x = idx * unit_w
-            q_color = QUALITY_COLORS.get(item_data.get("rln"), (100, 100, 100))
-            draw_y = (self.VIEWPORT_H - self.BASE_ITEM_SIZE) // 2 - 20
-            bar_h = 6
-            strip_draw.rectangle([x, draw_y + self.BASE_ITEM_SIZE, x + self.BASE_ITEM_SIZE, draw_y + self.BASE_ITEM_SIZE + bar_h], fill=q_color)
-            if img:
-                i_copy = img.copy()
-                i_copy.thumbnail((self.BASE_ITEM_SIZE, self.BASE_ITEM_SIZE), Image.Resampling.BICUBIC)
-                strip_img.paste(i_copy, (x, draw_y), i_copy)
-
-        frames = []
         scroll_frames = int(self.FPS * self.SCROLL_DURATION)
-        outro_frames = 20 
-        total_frames = scroll_frames + outro_frames
-        
-        REAL_WINNER_INDEX = self.WINNER_INDEX + self.HEAD_BUFFER
-        winner_center_x = REAL_WINNER_INDEX * unit_w + unit_w / 2
+        winner_center_x = (self.WINNER_INDEX + self.HEAD_BUFFER) * unit_w + unit_w / 2
         viewport_center_x = self.VIEWPORT_W / 2
         target_scroll_x = winner_center_x - viewport_center_x
-        random_offset = random.uniform(-0.4, 0.4) * self.BASE_ITEM_SIZE
         target_scroll_x += random_offset
         start_scroll_x = (self.HEAD_BUFFER * unit_w) - viewport_center_x
 
         def ease_out_cubic(t): return 1 - pow(1 - t, 3)
 
-        bg_color = (30, 30, 35, 255)
-        
-        for f in range(total_frames):
-            frame = Image.new("RGBA", (self.VIEWPORT_W, self.VIEWPORT_H), bg_color)
-            draw = ImageDraw.Draw(frame)
-            
-            is_outro = f >= scroll_frames
-
-            if not is_outro:
-                t = f / scroll_frames
-                current_scroll_x = start_scroll_x + (target_scroll_x - start_scroll_x) * ease_out_cubic(t)
-                crop_x = int(current_scroll_x)
-                crop_x = max(0, min(crop_x, strip_img.width - self.VIEWPORT_W))
-                viewport_slice = strip_img.crop((crop_x, 0, crop_x + self.VIEWPORT_W, self.VIEWPORT_H))
-                frame.paste(viewport_slice, (0, 0), viewport_slice)
-                
-                draw.rectangle([0, 0, 50, self.VIEWPORT_H], fill=(20, 20, 20, 100))
-                draw.rectangle([self.VIEWPORT_W-50, 0, self.VIEWPORT_W, self.VIEWPORT_H], fill=(20, 20, 20, 100))
-                mid = self.VIEWPORT_W // 2
-                draw.line([(mid, 15), (mid, self.VIEWPORT_H-15)], fill=(255, 215, 0, 200), width=3)
-                draw.polygon([(mid-8, 15), (mid+8, 15), (mid, 30)], fill=(255, 215, 0, 255))
-                draw.polygon([(mid-8, self.VIEWPORT_H-15), (mid+8, self.VIEWPORT_H-15), (mid, self.VIEWPORT_H-30)], fill=(255, 215, 0, 255))
+        offsets = []
+        for f in range(scroll_frames):
+            t = f / scroll_frames
+            current_scroll_x = start_scroll_x + (target_scroll_x - start_scroll_x) * ease_out_cubic(t)
+            crop_x = int(current_scroll_x)
+            offsets.append(max(0, min(crop_x, strip_width - self.VIEWPORT_W)))
+        return offsets
+
+    def _draw_overlay(self, draw, edge_fill, line_fill, marker_fill):
+        draw.rectangle([0, 0, 50, self.VIEWPORT_H], fill=edge_fill)
+        draw.rectangle([self.VIEWPORT_W-50, 0, self.VIEWPORT_W, self.VIEWPORT_H], fill=edge_fill)
+        mid = self.VIEWPORT_W // 2
+        draw.line([(mid, 15), (mid, self.VIEWPORT_H-15)], fill=line_fill, width=3)
+        draw.polygon([(mid-8, 15), (mid+8, 15), (mid, 30)], fill=marker_fill)
+        draw.polygon([(mid-8, self.VIEWPORT_H-15), (mid+8, self.VIEWPORT_H-15), (mid, self.VIEWPORT_H-30)], fill=marker_fill)
+
+    def _outro_frame(self, step, item_data, img):
+        outro_progress = step / self.OUTRO_FRAMES
+        scale = 1.0 + 0.3 * outro_progress # 1.0 -> 1.3
+
+        frame = Image.new("RGBA", (self.VIEWPORT_W, self.VIEWPORT_H), self.BG_COLOR)
+        draw = ImageDraw.Draw(frame)
+        q_color = QUALITY_COLORS.get(item_data.get("rln"), (100, 100, 100))
+
+        draw_w = int(self.BASE_ITEM_SIZE * scale)
+        draw_h = int(self.BASE_ITEM_SIZE * scale)
+        draw_x = (self.VIEWPORT_W - draw_w) // 2 
+        draw_y = (self.VIEWPORT_H - draw_h) // 2 - 20
+
+        bar_h = self.BAR_H * scale
+        draw.rectangle([draw_x, draw_y + draw_h, draw_x + draw_w, draw_y + draw_h + bar_h], fill=q_color)
+
+        if img:
+            i_zoom = img.copy()
+            i_zoom.thumbnail((draw_w, draw_h), Image.Resampling.BICUBIC)
+            frame.paste(i_zoom, (int(draw_x), int(draw_y)), i_zoom)
+
+        full_name = item_data.get("name", "???")
+        short_name = full_name.split("|")[-1].strip()
+        try:
+            text_bbox = draw.textbbox((0, 0), short_name, font=self.font_bold)
+            text_w = text_bbox[2] - text_bbox[0]
+        except: text_w = 50
 
-            else:
-                outro_progress = (f - scroll_frames) / outro_frames
-                scale = 1.0 + 0.3 * outro_progress # 1.0 -> 1.3
-                
-                item_data = items_data[REAL_WINNER_INDEX]
-                img = images[REAL_WINNER_INDEX]
-                q_color = QUALITY_COLORS.get(item_data.get("rln"), (100, 100, 100))
-                
-                draw_w = int(self.BASE_ITEM_SIZE * scale)
-                draw_h = int(self.BASE_ITEM_SIZE * scale)
-                draw_x = (self.VIEWPORT_W - draw_w) // 2 
-                draw_y = (self.VIEWPORT_H - draw_h) // 2 - 20
-                
-                bar_h = 6 * scale
-                draw.rectangle([draw_x, draw_y + draw_h, draw_x + draw_w, draw_y + draw_h + bar_h], fill=q_color)
-                
-                if img:
-                    i_zoom = img.copy()
-                    i_zoom.thumbnail((draw_w, draw_h), Image.Resampling.BICUBIC)
-                    frame.paste(i_zoom, (int(draw_x), int(draw_y)), i_zoom)
-                
-                full_name = item_data.get("name", "???")
-                short_name = full_name.split("|")[-1].strip()
-                try:
-                    text_bbox = draw.textbbox((0, 0), short_name, font=self.font_bold)
-                    text_w = text_bbox[2] - text_bbox[0]
-                except: text_w = 50
-                
-                text_draw_x = (self.VIEWPORT_W - text_w) // 2
-                text_draw_y = draw_y + draw_h + bar_h + 10
-                draw.text((text_draw_x, text_draw_y), short_name, fill=q_color, font=self.font_bold)
+        text_draw_x = (self.VIEWPORT_W - text_w) // 2
+        text_draw_y = draw_y + draw_h + bar_h + 10
+        draw.text((text_draw_x, text_draw_y), short_name, fill=q_color, font=self.font_bold)
+        return frame
+
+    def _record_render(self, mode, compose_s, encode_s, size, record=True):
+        """
+        渲染耗时统计 (在主进程中记录，渲染进程把耗时随结果一并返回)，同时按输出档位汇总
+        档位体积另记指数加权平均 (avg_bytes)；距上次样本超过 PROFILE_STALE_S 时旧均值作废，以新样本重新起算
+        record=False (渲染测试) 时不计入统计
+        """
+        if not record: return
+        m = self.metrics[mode]
+        m["renders"] += 1
+        m["compose_ms"] += compose_s * 1000
+        m["encode_ms"] += encode_s * 1000
+        m["bytes"] += size
+        p = self.profile_metrics[self.profile]
+        p["renders"] += 1
+        p["render_ms"] += (compose_s + encode_s) * 1000
+        p["bytes"] += size
+        p["max_bytes"] = max(p["max_bytes"], size)
+        now = time.monotonic()
+        if p["renders"] == 1 or now - p["last"] >= self.PROFILE_STALE_S:
+            p["avg_bytes"] = float(size)
+        else:
+            p["avg_bytes"] += self.PROFILE_EWMA_ALPHA * (size - p["avg_bytes"])
+        p["last"] = now
 
+    def _create_optimized_gif(self, items_data, atlas, winner_img, random_offset):
+        started = time.perf_counter()
+        strip_img = self._build_strip(items_data, atlas)
+        winner_data = items_data[self.WINNER_INDEX + self.HEAD_BUFFER]
+
+        frames = []
+        for crop_x in self._scroll_offsets(strip_img.width, random_offset):
+            frame = Image.new("RGBA", (self.VIEWPORT_W, self.VIEWPORT_H), self.BG_COLOR)
+            viewport_slice = strip_img.crop((crop_x, 0, crop_x + self.VIEWPORT_W, self.VIEWPORT_H))
+            frame.paste(viewport_slice, (0, 0), viewport_slice)
+            self._draw_overlay(ImageDraw.Draw(frame), (20, 20, 20, 100), (255, 215, 0, 200), (255, 215, 0, 255))
             frames.append(frame.convert("RGB"))
+        for step in range(self.OUTRO_FRAMES):
+            frames.append(self._outro_frame(step, winner_data, winner_img).convert("RGB"))
 
         if frames:
             last_frame = frames[-1]
-            for _ in range(20): frames.append(last_frame)
+            for _ in range(self.HOLD_FRAMES): frames.append(last_frame)
 
+        composed = time.perf_counter()
         output = BytesIO()
         if frames:
             frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=int(1000/self.FPS), loop=0, optimize=True)
-        return output.getvalue()
+        return output.getvalue(), "legacy", composed - started, time.perf_counter() - composed
+
+    def _shared_palette(self, atlas):
+        """
+        由图集生成整张动图共用的调色板 (结果缓存在图集上)
+        背景、遮罩、指针、品质色及其与背景的过渡色固定在前部，其余名额按图集内容自适应分配
+        返回 (调色板图像, 固定色索引)
+        """
+        if getattr(atlas, "palette", None) is not None: return atlas.palette
+        bg = self.BG_COLOR[:3]
+        fixed = [bg, (20, 20, 20), (255, 215, 0), (100, 100, 100)]
+        for color in QUALITY_COLORS.values():
+            for k in (1, 2, 3, 4):
+                fixed.append(tuple(int(b + (c - b) * k / 4) for b, c in zip(bg, color)))
+        fixed = list(dict.fromkeys(fixed))
+
+        sample = Image.new("RGBA", atlas.image.size, self.BG_COLOR)
+        sample.paste(atlas.image, (0, 0), atlas.image)
+        adaptive = sample.convert("RGB").quantize(colors=256 - len(fixed), method=Image.Quantize.MEDIANCUT)
+        flat = [v for color in fixed for v in color] + adaptive.getpalette()[:3 * (256 - len(fixed))]
+        flat += [0] * (768 - len(flat))
+        palette_img = Image.new("P", (1, 1))
+        palette_img.putpalette(flat)
+        atlas.palette = (palette_img, {"bg": 0, "edge": 1, "gold": 2})
+        return atlas.palette
+
+    def _create_fast_gif(self, items_data, atlas, winner_img, random_offset):
+        """
+        快速编码：整张动图共用一个调色板，帧直接以 P 模式生成
+        滚动帧由预先量化好的条带裁剪得到，只在其上按索引绘制遮罩和指针；
+        结尾停留改为一帧长时长，帧间差异区域由 Pillow 按包围盒增量写入
+        """
+        started = time.perf_counter()
+        strip_img = self._build_strip(items_data, atlas)
+        winner_data = items_data[self.WINNER_INDEX + self.HEAD_BUFFER]
+        palette_img, idx = self._shared_palette(atlas)
+
+        base = Image.new("RGBA", strip_img.size, self.BG_COLOR)
+        base.paste(strip_img, (0, 0), strip_img)
+        strip_p = base.convert("RGB").quantize(palette=palette_img, dither=Image.Dither.NONE)
+
+        frames = []
+        for crop_x in self._scroll_offsets(strip_img.width, random_offset):
+            frame = strip_p.crop((crop_x, 0, crop_x + self.VIEWPORT_W, self.VIEWPORT_H))
+            self._draw_overlay(ImageDraw.Draw(frame), idx["edge"], idx["gold"], idx["gold"])
+            frames.append(frame)
+        for step in range(self.OUTRO_FRAMES):
+            frame = self._outro_frame(step, winner_data, winner_img).convert("RGB")
+            frames.append(frame.quantize(palette=palette_img, dither=Image.Dither.NONE))
+
+        frame_ms = int(1000 / self.FPS)
+        durations = [frame_ms] * len(frames)
+        durations[-1] = frame_ms * (self.HOLD_FRAMES + 1)
+
+        composed = time.perf_counter()
+        output = BytesIO()
+        frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=durations, loop=0, optimize=False)
+        return output.getvalue(), "fast", composed - started, time.perf_counter() - composed
+
+    async def _generate_from_template(self, winner_item, winner_img, filler_pool, atlas, record=True):
+        """
+        随机选一个模板，只补画中奖格可见的滚动帧与结尾帧；模板不可用时返回 None
+        配置了渲染进程时交给渲染进程拼接 (各进程各自缓存模板)，进程池不可用时在本进程线程中完成
+        """
+        key = ("gif", self.profile, atlas.key, random.randrange(self.TEMPLATE_VARIANTS), random.randrange(self.TEMPLATE_OFFSETS))
+        if self.render_pool is not None:
+            job = {
+                "key": key,
+                "atlas_key": atlas.key,
+                "winner": {"img": winner_item.get("img"), "rln": winner_item.get("rln"), "name": winner_item.get("name", "???")},
+                "has_winner_img": winner_img is not None,
+                "fillers": [{"img": i.get("img"), "rln": i.get("rln")} for i in filler_pool],
+                "profile": self.profile,
+            }
+            result = await self.render_pool.run(_render_template_job, job)
+            if result is not None:
+                data, compose_s, encode_s, build_ms = result
+                if build_ms is not None:
+                    self.template_metrics["built"] += 1
+                    self.template_metrics["build_ms"] += build_ms
+                self._record_render("template", compose_s, encode_s, len(data), record)
+                return data
+        template = self.templates.get(key)
+        if template is None:
+            task = self._template_inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(asyncio.to_thread(self._build_template, key, atlas, filler_pool))
+                self._template_inflight[key] = task
+                task.add_done_callback(lambda _: self._template_inflight.pop(key, None))
+            template = await asyncio.shield(task)
+        result = None
+        if template is not None:
+            result = await asyncio.to_thread(self._render_from_template, template, atlas, winner_item, winner_img)
+        if result is None:
+            self.template_metrics["fallbacks"] += 1
+            return None
+        data, compose_s, encode_s = result
+        self._record_render("template", compose_s, encode_s, len(data), record)
+        return data
+
+    def render_template_job(self, job):
+        """渲染进程内执行模板拼接，返回 (数据, 合成耗时, 编码耗时, 模板生成耗时或 None)；无法完成时返回 None"""
+        if self.templates is None: return None
+        atlas = self.atlas_store.load_cached(job["atlas_key"])
+        if atlas is None: return None
+        winner_img = self.img_mgr.load_cached(job["winner"]["img"])
+        if job["has_winner_img"] and winner_img is None: return None
+        key, build_ms = job["key"], None
+        template = self.templates.get(key)
+        if template is None:
+            started = time.perf_counter()
+            template = self._build_template(key, atlas, job["fillers"])
+            if template is None: return None
+            build_ms = (time.perf_counter() - started) * 1000
+        result = self._render_from_template(template, atlas, job["winner"], winner_img)
+        if result is None: return None
+        return (*result, build_ms)
+
+    @staticmethod
+    def _gif_header_len(data):
+        """GIF 文件头 + 逻辑屏幕描述 + 全局调色板的长度"""
+        flags = data[10]
+        return 13 + (3 << ((flags & 7) + 1) if flags & 0x80 else 0)
+
+    def _encode_segment(self, frames, durations, loop=False):
+        """编码一段帧，返回 (文件头, 帧数据)；帧数据不含循环扩展和结尾符，可直接拼接"""
+        output = BytesIO()
+        extra = {"loop": 0} if loop else {}
+        frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:], duration=durations, optimize=False, **extra)
+        data = output.getvalue()
+        head = self._gif_header_len(data)
+        return data[:head], data[head:-1]
+
+    def _build_template(self, key, atlas, filler_pool):
+        """
+        生成一个动画模板：中奖格留空的填充条带，按停止档位计算滚动轨迹，
+        中奖格进入视野前的帧直接编码成字节；之后的帧只保留所需的量化条带片段，请求时补画中奖格
+        """
+        started = time.perf_counter()
+        _, _, _, variant, step = key
+        rng = random.Random(f"{atlas.key}:{variant}")
+        items = [rng.choice(filler_pool) for _ in range(self.TOTAL_ITEMS + self.HEAD_BUFFER)]
+        items[self.WINNER_INDEX + self.HEAD_BUFFER] = None
+        offset = (-0.4 + 0.8 * step / max(1, self.TEMPLATE_OFFSETS - 1)) * self.BASE_ITEM_SIZE
+
+        strip_img = self._build_strip(items, atlas)
+        palette_img, idx = self._shared_palette(atlas)
+        base = Image.new("RGBA", strip_img.size, self.BG_COLOR)
+        base.paste(strip_img, (0, 0), strip_img)
+        strip_p = base.convert("RGB").quantize(palette=palette_img, dither=Image.Dither.NONE)
+
+        offsets = self._scroll_offsets(strip_img.width, offset)
+        slot_x = (self.WINNER_INDEX + self.HEAD_BUFFER) * (self.BASE_ITEM_SIZE + self.MARGIN)
+        # 缓出轨迹单调递增，中奖格一旦进入视野便不再离开
+        split = next((i for i, x in enumerate(offsets) if x + self.VIEWPORT_W > slot_x), len(offsets))
+        if split == 0 or split == len(offsets): return None
+
+        frames = []
+        for crop_x in offsets[:split]:
+            frame = strip_p.crop((crop_x, 0, crop_x + self.VIEWPORT_W, self.VIEWPORT_H))
+            self._draw_overlay(ImageDraw.Draw(frame), idx["edge"], idx["gold"], idx["gold"])
+            frames.append(frame)
+        header, prefix = self._encode_segment(frames, int(1000 / self.FPS), loop=True)
+        visible = offsets[split:]
+        tail_x = visible[0]
+        tail = strip_p.crop((tail_x, 0, visible[-1] + self.VIEWPORT_W, self.VIEWPORT_H))
+
+        template = {"header": header, "prefix": prefix, "tail": tail, "tail_x": tail_x, "offsets": visible, "slot_x": slot_x}
+        self.templates.put(key, template, cost=len(header) + len(prefix) + tail.width * tail.height)
+        self.template_metrics["built"] += 1
+        self.template_metrics["build_ms"] += (time.perf_counter() - started) * 1000
+        return template
+
+    def _outro_segment(self, atlas, winner_item, winner_img, header):
+        """结尾放大帧只取决于中奖物品，按物品缓存编码结果"""
+        key = ("outro", self.profile, atlas.key, winner_item.get("img"), winner_item.get("rln"), winner_item.get("name", "???"))
+        body = self.templates.get(key)
+        if body is not None: return body
+        palette_img, _ = self._shared_palette(atlas)
+        frames = [self._outro_frame(step, winner_item, winner_img).convert("RGB").quantize(palette=palette_img, dither=Image.Dither.NONE)
+                  for step in range(self.OUTRO_FRAMES)]
+        frame_ms = int(1000 / self.FPS)
+        durations = [frame_ms] * len(frames)
+        durations[-1] = frame_ms * (self.HOLD_FRAMES + 1)
+        head, body = self._encode_segment(frames, durations)
+        if head != header: return None
+        self.templates.put(key, body, cost=len(body))
+        return body
+
+    def _render_from_template(self, template, atlas, winner_item, winner_img):
+        """返回 (GIF 数据, 合成耗时, 编码耗时)；各段调色板不一致时返回 None"""
+        started = time.perf_counter()
+        palette_img, idx = self._shared_palette(atlas)
+        tile = atlas.tile(AtlasStore.tile_key(winner_item))
+        tile_bg = Image.new("RGBA", tile.size, self.BG_COLOR)
+        tile_bg.paste(tile, (0, 0), tile)
+        tile_p = tile_bg.convert("RGB").quantize(palette=palette_img, dither=Image.Dither.NONE)
+
+        tail, tail_x, slot_x = template["tail"], template["tail_x"], template["slot_x"]
+        draw_y = (self.VIEWPORT_H - self.BASE_ITEM_SIZE) // 2 - 20
+        frames = []
+        for crop_x in template["offsets"]:
+            x = crop_x - tail_x
+            frame = tail.crop((x, 0, x + self.VIEWPORT_W, self.VIEWPORT_H))
+            frame.paste(tile_p, (slot_x - crop_x, draw_y))
+            self._draw_overlay(ImageDraw.Draw(frame), idx["edge"], idx["gold"], idx["gold"])
+            frames.append(frame)
+
+        composed = time.perf_counter()
+        head, visible = self._encode_segment(frames, int(1000 / self.FPS))
+        outro = self._outro_segment(atlas, winner_item, winner_img, template["header"])
+        if head != template["header"] or outro is None: return None
+        data = b"".join((template["header"], template["prefix"], visible, outro, b";"))
+        return data, composed - started, time.perf_counter() - composed
+
+    def _create_webp(self, items_data, atlas, winner_img, random_offset):
+        """动画 WebP：帧内容与快速编码一致，但保留全彩 (有损压缩)"""
+        started = time.perf_counter()
+        strip_img = self._build_strip(items_data, atlas)
+        winner_data = items_data[self.WINNER_INDEX + self.HEAD_BUFFER]
+        base = Image.new("RGBA", strip_img.size, self.BG_COLOR)
+        base.paste(strip_img, (0, 0), strip_img)
+        strip_rgb = base.convert("RGB")
+
+        frames = []
+        for crop_x in self._scroll_offsets(strip_img.width, random_offset):
+            frame = strip_rgb.crop((crop_x, 0, crop_x + self.VIEWPORT_W, self.VIEWPORT_H))
+            self._draw_overlay(ImageDraw.Draw(frame), (20, 20, 20), (255, 215, 0), (255, 215, 0))
+            frames.append(frame)
+        for step in range(self.OUTRO_FRAMES):
+            frames.append(self._outro_frame(step, winner_data, winner_img).convert("RGB"))
+
+        frame_ms = int(1000 / self.FPS)
+        durations = [frame_ms] * len(frames)
+        durations[-1] = frame_ms * (self.HOLD_FRAMES + 1)
+
+        composed = time.perf_counter()
+        output = BytesIO()
+        frames[0].save(output, format="WEBP", save_all=True, append_images=frames[1:], duration=durations, loop=0,
+                       quality=self.WEBP_QUALITY, method=0)
+        return output.getvalue(), "webp", composed - started, time.perf_counter() - composed
+
+    def _create_static(self, winner_item, winner_img):
+        """静态档位：只输出结尾定格的结果卡片"""
+        started = time.perf_counter()
+        frame = self._outro_frame(self.OUTRO_FRAMES - 1, winner_item, winner_img).convert("RGB")
+        composed = time.perf_counter()
+        output = BytesIO()
+        frame.save(output, format="PNG")
+        return output.getvalue(), composed - started, time.perf_counter() - composed
 
     async def generate_inventory_card(self, stats_data, item_img_map):
-        return await asyncio.to_thread(self._create_inv_card_sync, stats_data, item_img_map)
+        urls = [item.get('img_url') for item in stats_data['items']]
+        images = await asyncio.gather(*[self.img_mgr.get_image(u) for u in urls])
+        if self.render_pool is not None:
+            data = await self.render_pool.run(_render_inventory_job, stats_data, urls)
+            if data is not None: return data
+        return await asyncio.to_thread(self._create_inv_card_sync, stats_data, images)
 
-    def _create_inv_card_sync(self, stats_data, item_img_map):
+    def render_inventory_job(self, stats_data, urls):
+        return self._create_inv_card_sync(stats_data, [self.img_mgr.load_cached(u) for u in urls])
+
+    def _create_inv_card_sync(self, stats_data, item_images):
         width = 650
         header_h = 80
         stats_h = 100
@@ -606,23 +2144,15 @@ class GifGenerator:
         draw.line([(padding, list_y-10), (width-padding, list_y-10)], fill=(60,60,60), width=1)
         draw.text((padding, list_y-35), "💎 最近稀有掉落", fill=(255, 255, 255), font=self.font)
         
-        for item in rare_items:
+        for item, item_img_obj in zip(rare_items, item_images):
             bg_rect = [padding, list_y, width-padding, list_y+item_h]
             draw.rectangle(bg_rect, fill=(40, 40, 45), outline=(60, 60, 60))
             q_color = QUALITY_COLORS.get(item['quality'], (150, 150, 150))
             draw.rectangle([padding, list_y, padding+5, list_y+item_h], fill=q_color)
             
-            img_url = item.get('img_url')
-            if img_url:
-                local_path = self.img_mgr._get_file_path(img_url)
-                item_img_obj = None
-                if os.path.exists(local_path):
-                    try: item_img_obj = Image.open(local_path).convert("RGBA")
-                    except: pass
-                else:
-                    item_img_obj = self.img_mgr._download_sync(img_url, local_path)
-                
+            if item.get('img_url'):
                 if item_img_obj:
+                    item_img_obj = item_img_obj.copy()
                     item_img_obj.thumbnail((70, 70), Image.Resampling.LANCZOS)
                     paste_x = padding + 15
                     paste_y = list_y + (item_h - item_img_obj.height) // 2
@@ -642,8 +2172,86 @@ class GifGenerator:
         img.save(output, format="PNG")
         return output.getvalue()
 
+    #  生成批量开箱结果拼图
+    async def generate_result_collage(self, items, highlights, show_wear=True):
+        """
+        把多件开箱结果拼成一张网格图 (图片取自本地缓存)，highlights 与 items 一一对应，标记需要高亮的格子
+        超过格子上限时最后一格改为“+N 件”提示，高亮物品优先保留在图中
+        """
+        hidden = 0
+        if len(items) > self.COLLAGE_MAX_TILES:
+            order = sorted(range(len(items)), key=lambda i: not highlights[i])
+            keep = sorted(order[:self.COLLAGE_MAX_TILES - 1])
+            hidden = len(items) - len(keep)
+            items, highlights = [items[i] for i in keep], [highlights[i] for i in keep]
+        images = await asyncio.gather(*[self.img_mgr.get_image(item.get("img")) for item in items])
+        return await asyncio.to_thread(self._create_collage_sync, items, images, highlights, show_wear, hidden)
+
+    def _fit_text(self, draw, text, font, max_w):
+        try:
+            if draw.textlength(text, font=font) <= max_w: return text
+            while text and draw.textlength(text + "…", font=font) > max_w: text = text[:-1]
+            return text + "…"
+        except Exception:
+            return text
+
+    def _create_collage_sync(self, items, images, highlights, show_wear, hidden=0):
+        tile_w, tile_h = 180, 200
+        img_box = 150
+        gap = 10
+        padding = 15
+        tiles = len(items) + (1 if hidden else 0)
+        cols = min(self.COLLAGE_COLUMNS, max(1, tiles))
+        rows = (tiles + cols - 1) // cols
+        width = padding * 2 + cols * tile_w + (cols - 1) * gap
+        height = padding * 2 + rows * tile_h + (rows - 1) * gap
+
+        img = Image.new("RGB", (width, height), (30, 30, 35))
+        draw = ImageDraw.Draw(img)
+
+        for idx, (item, item_img_obj, highlight) in enumerate(zip(items, images, highlights)):
+            x = padding + (idx % cols) * (tile_w + gap)
+            y = padding + (idx // cols) * (tile_h + gap)
+            q_color = QUALITY_COLORS.get(item.get('quality'), (150, 150, 150))
+            if highlight:
+                draw.rectangle([x, y, x + tile_w, y + tile_h], fill=(60, 52, 25), outline=(255, 215, 0), width=3)
+            else:
+                draw.rectangle([x, y, x + tile_w, y + tile_h], fill=(40, 40, 45), outline=(60, 60, 60))
+
+            thumb = self.img_mgr.thumbnail(item.get("img"), item_img_obj, (img_box, img_box - 40))
+            if thumb:
+                img.paste(thumb, (x + (tile_w - thumb.width) // 2, y + 10 + (img_box - 40 - thumb.height) // 2), thumb)
+            else:
+                draw.text((x + tile_w // 2 - 5, y + 45), "?", fill=(100, 100, 100), font=self.font_bold)
+
+            bar_y = y + img_box - 20
+            draw.rectangle([x + 10, bar_y, x + tile_w - 10, bar_y + 4], fill=q_color)
+            name = item.get('name', '???').split("|")[-1].strip()
+            draw.text((x + 10, bar_y + 12), self._fit_text(draw, name, self.font, tile_w - 20), fill=q_color, font=self.font)
+            if show_wear and item.get('wear_level'):
+                wear = f"{item['wear_level']} {item['wear_value']:.4f}"
+                draw.text((x + 10, bar_y + 36), self._fit_text(draw, wear, self.font, tile_w - 20), fill=(150, 150, 150), font=self.font)
+
+        if hidden:
+            idx = len(items)
+            x = padding + (idx % cols) * (tile_w + gap)
+            y = padding + (idx // cols) * (tile_h + gap)
+            draw.rectangle([x, y, x + tile_w, y + tile_h], fill=(40, 40, 45), outline=(60, 60, 60))
+            draw.text((x + 20, y + 70), f"+{hidden} 件", fill=(255, 215, 0), font=self.font_title)
+            draw.text((x + 20, y + 110), "完整列表见下方文字", fill=(150, 150, 150), font=self.font)
+
+        output = BytesIO()
+        img.save(output, format="PNG")
+        return output.getvalue()
+
     #  生成菜单图片
     def generate_help_card(self):
+        """菜单图片只取决于指令列表，生成一次后复用编码好的 PNG"""
+        if self._help_card is None:
+            self._help_card = self._render_help_card()
+        return self._help_card
+
+    def _render_help_card(self):
         width = 600
         commands = [
             ("📦 开箱[数量] [名称]", "开指定数量的武器箱/纪念包(如: 开箱 10 命悬)"),
@@ -651,8 +2259,11 @@ class GifGenerator:
             ("💰 查询价格 [名称]", "查询饰品BUFF/Steam参考价格"),
             ("📜 武器箱列表", "查看所有可开箱的容器名称"),
             ("🗑️ 清除库存", "清空自己的所有开箱记录(不可恢复)"),
-            ("🔄 更新武器箱", "(管理员) 从服务器同步最新数据"),
-            ("🧹 清除缓存", "(管理员) 清理本地临时图片文件"),
+            ("🔄 更新武器箱 [--full]", "(管理员) 增量同步最新数据，--full 强制全量"),
+            ("🧹 清除缓存", "(管理员) 清理本地图片缓存与图集"),
+            ("🔥 预热缓存 [停止]", "(管理员) 后台预先下载图片并生成缩略图"),
+            ("📈 开箱状态", "(管理员) 查看数据库与缓存运行指标"),
+            ("🎬 渲染测试 [箱名]", "(管理员) 用各输出档位各渲染一次，对比体积与耗时"),
         ]
         height = max(480, 130 + len(commands) * 70)
         img = Image.new("RGB", (width, height), (30, 30, 35))
@@ -660,7 +2271,7 @@ class GifGenerator:
 
         # 标题
         draw.text((20, 20), "🔫 CS2 开箱模拟", fill=(255, 215, 0), font=self.font_title)
-        draw.text((20, 60), "v1.3", fill=(150, 150, 150), font=self.font)
+        draw.text((20, 60), "v1.4", fill=(150, 150, 150), font=self.font)
 
         # 分割线
         draw.line([(20, 90), (width-20, 90)], fill=(60, 60, 60), width=2)
@@ -678,36 +2289,275 @@ class GifGenerator:
         img.save(output, format="PNG")
         return output.getvalue()
 
-@register("CS武器箱开箱模拟", "luooka", "支持武器箱、纪念包、收藏品开箱模拟(带动画)", "1.3")
+# ================= 辅助类：多进程渲染 =================
+# 渲染进程内的常驻生成器 (字体、图片与图集缓存在进程生命周期内复用)
+_RENDER_WORKER = None
+
+def _render_worker_init(fast_encoder, memory_cache_bytes, template_cache_bytes=0):
+    global _RENDER_WORKER
+    _RENDER_WORKER = GifGenerator(ImageManager(None, 0, memory_cache_bytes), fast_encoder,
+                                  template_cache_bytes=template_cache_bytes)
+
+def _render_worker_ping():
+    return os.getpid()
+
+def _render_gif_job(job):
+    return _RENDER_WORKER.variant(job.get("profile", "full")).render_gif_job(job)
+
+def _render_template_job(job):
+    return _RENDER_WORKER.variant(job["profile"]).render_template_job(job)
+
+def _render_inventory_job(stats_data, urls):
+    return _RENDER_WORKER.render_inventory_job(stats_data, urls)
+
+class RenderPool:
+    """
+    可选的多进程渲染后端，绕开 GIL 让多个渲染并行
+    排队任务超过上限、进程池损坏或任务失败时 run() 返回 None，调用方回退到线程渲染
+    """
+    def __init__(self, workers, max_queue, fast_encoder=True, memory_cache_bytes=64 * 1024 * 1024, template_cache_bytes=0):
+        self.workers = workers
+        self.max_queue = max(workers, max_queue)
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=self._mp_context(), initializer=_render_worker_init, initargs=(fast_encoder, memory_cache_bytes, template_cache_bytes))
+        self._pending = 0
+        self._broken = False
+        self.metrics = {"jobs": 0, "rejected": 0, "errors": 0}
+
+    @staticmethod
+    def _mp_context():
+        """
+        不使用 Linux 默认的 fork：在多线程的事件循环进程中 fork 会把持有中的锁、
+        aiohttp 会话与 SQLite 连接一并复制进子进程；worker 入口均为模块级函数，可正常序列化
+        """
+        methods = multiprocessing.get_all_start_methods()
+        return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+    def warm(self):
+        """预先拉起全部渲染进程，避免首个请求承担进程启动与字体加载"""
+        for _ in range(self.workers):
+            self._executor.submit(_render_worker_ping)
+
+    async def run(self, fn, *args):
+        if self._broken: return None
+        if self._pending >= self.max_queue:
+            self.metrics["rejected"] += 1
+            return None
+        self._pending += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+            self.metrics["jobs"] += 1
+            return result
+        except BrokenProcessPool as e:
+            self._broken = True
+            self.metrics["errors"] += 1
+            print(f"渲染进程池已损坏，改用线程渲染: {e}")
+            return None
+        except Exception as e:
+            self.metrics["errors"] += 1
+            print(f"渲染进程任务失败，改用线程渲染: {e}")
+            return None
+        finally:
+            self._pending -= 1
+
+    def stats(self):
+        return dict(self.metrics, workers=self.workers, pending=self._pending, max_queue=self.max_queue, broken=self._broken)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# ================= 辅助类：渲染调度 =================
+class RenderScheduler:
+    """
+    渲染准入控制：全局并发上限 + 按群轮转的公平排队
+    释放名额时依次交给下一个有排队的群，避免单个群刷屏占满渲染；排队已满时拒绝，由调用方降级为静态结果
+    """
+    SLOW_LOG_S = 10  # 排队加渲染超过该秒数时打印一条日志，其余只计入统计
+
+    def __init__(self, max_concurrent=2, max_waiting=10):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_waiting = max(0, max_waiting)
+        self._running = 0
+        self._queued = 0
+        self._waiting = {}
+        self._rotation = deque()
+        self.metrics = {"granted": 0, "degraded": 0, "wait_ms": 0.0, "wait_max_ms": 0.0, "renders": 0, "render_ms": 0.0}
+
+    async def acquire(self, group):
+        """获取渲染名额，返回排队耗时 (秒)；排队已满时返回 None"""
+        started = time.monotonic()
+        if self._running < self.max_concurrent and not self._queued:
+            self._running += 1
+        else:
+            if self._queued >= self.max_waiting:
+                self.metrics["degraded"] += 1
+                return None
+            fut = asyncio.get_running_loop().create_future()
+            q = self._waiting.get(group)
+            if q is None:
+                q = self._waiting[group] = deque()
+                self._rotation.append(group)
+            q.append(fut)
+            self._queued += 1
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self.release()  # 名额已转交但请求被取消，继续传给下一个
+                else:
+                    self._discard(group, fut)
+                raise
+        wait = time.monotonic() - started
+        self.metrics["granted"] += 1
+        self.metrics["wait_ms"] += wait * 1000
+        self.metrics["wait_max_ms"] = max(self.metrics["wait_max_ms"], wait * 1000)
+        return wait
+
+    def release(self):
+        """归还名额：有排队时直接转交给轮转中的下一个群"""
+        while self._rotation:
+            group = self._rotation.popleft()
+            q = self._waiting[group]
+            fut = q.popleft()
+            self._queued -= 1
+            if q: self._rotation.append(group)
+            else: del self._waiting[group]
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._running -= 1
+
+    def _discard(self, group, fut):
+        q = self._waiting.get(group)
+        if not q or fut not in q: return
+        q.remove(fut)
+        self._queued -= 1
+        if not q:
+            del self._waiting[group]
+            self._rotation.remove(group)
+
+    def record(self, group, kind, wait, render_s):
+        self.metrics["renders"] += 1
+        self.metrics["render_ms"] += render_s * 1000
+        if wait + render_s >= self.SLOW_LOG_S:
+            print(f"[渲染] {kind} 群{group} 耗时过长: 排队 {wait * 1000:.0f}ms, 渲染 {render_s * 1000:.0f}ms")
+
+    def stats(self):
+        return dict(self.metrics, running=self._running, queued=self._queued,
+                    max_concurrent=self.max_concurrent, max_waiting=self.max_waiting)
+
+@register("CS武器箱开箱模拟", "luooka", "支持武器箱、纪念包、收藏品开箱模拟(带动画)", "1.4")
 class CasePlugin(Star):
+    # 后台缓存维护 (磁盘缓存淘汰、索引落库、临时输出回收) 间隔，秒
+    MAINTENANCE_INTERVAL = 300
+    # 预热进度推送间隔 (秒)；进行中的开箱达到该数量或渲染出现排队时预热暂停
+    PREWARM_REPORT_INTERVAL = 60
+    PREWARM_PAUSE_OPENS = 2
+    INVENTORY_CARD_CACHE_SIZE = 256
+    DEGRADED_NOTICE = "\n(当前开箱人数较多，已省略动画)"
+    COVER_WIDTH = 180
+    PROFILE_MIN_SAMPLES = 3
+
     def __init__(self, context: Context, config: dict):
         super().__init__(context)
         self.config = config
         
-        self.api_host = self.config.get('api_host', 'api.csqaq.com').replace("https://", "").replace("http://", "").strip("/")
+        raw_host = str(self.config.get('api_host', 'api.csqaq.com')).strip()
+        self.api_host = raw_host.replace("https://", "").replace("http://", "").strip("/")
+        # 允许 http:// 前缀 (如本地替身服务)，默认 https
+        self.api_base = f"{'http' if raw_host.startswith('http://') else 'https'}://{self.api_host}"
         self.api_token = self.config.get('api_token', 'GWBR21M7K474Z3R5Y5H8K9J6')
         
-        self.net_mgr = NetworkManager(self.api_token) 
+        self.http = AsyncHttpClient(
+            per_host_limit=self._safe_int(self.config.get("http_per_host_limit", 4), 4, minimum=1),
+            timeout=self._safe_int(self.config.get("http_timeout", 20), 20, minimum=1),
+        )
+        self.net_mgr = NetworkManager(self.api_token, self.http)
+        self.api_limiter = TokenBucket(self._api_rate())
+        price_ttl = self._safe_int(self.config.get("price_cache_ttl", 300), 300, minimum=0)
+        self.price_svc = PriceService(self.net_mgr, self.api_base, self.api_limiter, price_ttl)
         cache_days = self._safe_int(self.config.get("cache_retention_days", 0), 0, minimum=0)
-        self.img_mgr = ImageManager(cache_days)
-        self.gif_gen = GifGenerator(self.img_mgr)
-        self.db = DatabaseManager() 
+        mem_mb = self._safe_int(self.config.get("image_memory_cache_mb", 64), 64, minimum=0)
+        disk_mb = self._safe_int(self.config.get("image_cache_max_mb", 512), 512, minimum=0)
+        self.img_mgr = ImageManager(self.http, cache_days, mem_mb * 1024 * 1024, disk_mb * 1024 * 1024)
+        spool_dir = str(self.config.get("media_spool_dir", "") or "").strip()
+        self.media = MediaOutput(str(self.config.get("media_output_mode", "auto")).strip().lower(),
+                                 TempOutputManager(spool_dir or None))
+        fast_gif = bool(self.config.get("gif_fast_encoder", True))
+        render_workers = self._safe_int(self.config.get("render_workers", 0), 0, minimum=0)
+        template_mb = self._safe_int(self.config.get("animation_template_cache_mb", 64), 64, minimum=0)
+        self.render_pool = None
+        if render_workers > 0:
+            self.render_pool = RenderPool(
+                render_workers, self._safe_int(self.config.get("render_queue_depth", 16), 16, minimum=1),
+                fast_gif, mem_mb * 1024 * 1024, template_mb * 1024 * 1024)
+            self.render_pool.warm()
+        self.gif_gen = GifGenerator(self.img_mgr, fast_gif, self.render_pool, template_mb * 1024 * 1024)
+        self.render_scheduler = RenderScheduler(
+            self._safe_int(self.config.get("render_concurrency", 2), 2, minimum=1),
+            self._safe_int(self.config.get("render_max_waiting", 10), 10, minimum=0))
+        self.db = DatabaseManager(self._safe_int(self.config.get("db_reader_pool_size", 4), 4, minimum=1))
+        self.db_writer = DBWriter(self.db)
+        self.img_mgr.load_index(self.db.load_image_index())
+        self._maintenance_task = None
+        self._active_opens = 0
+        # 按用户缓存的库存卡片 {user_key: png} (LRU)，以及正在渲染的库存 {user_key: 渲染期间是否有新写入}
+        # 两者都只包含近期查看过库存的用户，不随开箱用户数增长
+        self._inventory_cards = OrderedDict()
+        self._inventory_rendering = {}
+        self._prewarm = None
+        self._prewarm_task = None
+        self._sync_lock = asyncio.Lock()
         
         self.db.migrate_cases() 
-        self.case_data, self.case_images, self.item_img_map = self.db.load_all_data()
         
+        if np is not None:
+            self._np_rng = np.random.default_rng()
+            self._wear_bounds = {
+                "lo": np.array([wl[2] for wl in WEAR_LEVELS]),
+                "hi": np.array([wl[3] for wl in WEAR_LEVELS]),
+                "doppler_lo": np.array([wl[2] for wl in DOPPLER_WEAR_LEVELS]),
+                "doppler_hi": np.array([wl[3] for wl in DOPPLER_WEAR_LEVELS]),
+            }
+        version, case_data, case_images, hashes = self.db.load_catalog()
+        self.catalog = self._build_catalog(version, case_data, case_images, hashes)
+        self.gif_gen.atlas_store.prune(hashes.values())
+
         if os.path.exists(HISTORY_FILE):
-            self.db.migrate_json_history(self.item_img_map)
-            
-        self._recalculate_probabilities(self.case_data)
+            self.db.migrate_json_history(self.catalog.item_img_map)
         
         raw_admins = self.config.get("admins", "510591108")
         if isinstance(raw_admins, list):
             self.admins = [str(x) for x in raw_admins]
         else:
             self.admins = [x.strip() for x in str(raw_admins).replace("，", ",").split(",") if x.strip()]
+
+        self.render_profile = self._profile_name(self.config.get("render_profile", "full"))
+        raw_profiles = self.config.get("group_render_profiles", "")
+        if not isinstance(raw_profiles, list):
+            raw_profiles = str(raw_profiles).replace("，", ",").replace("：", ":").split(",")
+        self.group_profiles = {}
+        for entry in raw_profiles:
+            gid, _, name = str(entry).partition(":")
+            if not gid.strip(): continue
+            if name.strip().lower() not in GifGenerator.PROFILES:
+                print(f"忽略无效的群输出档位配置: {str(entry).strip()}")
+                continue
+            self.group_profiles[gid.strip()] = self._profile_name(name)
+        self.render_wait_budget = self._safe_int(self.config.get("render_wait_budget_ms", 2000), 2000, minimum=0) / 1000
+        self.render_size_budget = self._safe_int(self.config.get("render_size_budget_kb", 4096), 4096, minimum=0) * 1024
+        self.profile_downgrades = {"wait": 0, "size": 0}
+        self._profile_probes = {}
             
-        print(f"插件加载完成 (v4.4 Release)。Config: Number={self.config.get('number', 10)}, Admins={self.admins}")
+        print(f"插件加载完成 (v1.4)。Config: Number={self.config.get('number', 10)}, Admins={self.admins}")
+
+    def _profile_name(self, value, default="full"):
+        name = str(value or "").strip().lower()
+        if name not in GifGenerator.PROFILES: return default
+        if name not in GifGenerator.available_profiles():
+            print(f"当前 Pillow 不支持 {name} 输出，改用 {default}")
+            return default
+        return name
 
     def _safe_int(self, value, default, minimum=0):
         try:
@@ -716,6 +2566,9 @@ class CasePlugin(Star):
             num = default
         return max(minimum, num)
 
+    def _display_limit(self) -> int:
+        return self._safe_int(self.config.get("number", 10), 10, minimum=1)
+
     def _max_open_per_request(self) -> int:
         return self._safe_int(self.config.get("max_open_per_request", 50), 50, minimum=1)
 
@@ -765,7 +2618,71 @@ class CasePlugin(Star):
             return PROB_CATEGORY_3
         return PROB_CATEGORY_1
 
+    def _build_catalog(self, version, case_data, case_images, hashes, previous=None):
+        """
+        构建新目录快照：内容哈希未变的容器直接复用旧快照的物品与抽样器，只重算变更部分
+        """
+        reused = {}
+        if previous:
+            reused = {n: previous.case_data[n] for n in case_data
+                      if n in previous.case_data and previous.hashes.get(n) == hashes.get(n)}
+        fresh = {n: items for n, items in case_data.items() if n not in reused}
+        samplers = self._recalculate_probabilities(fresh)
+        batch_tables = {}
+        for n in reused:
+            samplers[n] = previous.samplers[n]
+            if n in previous.batch_tables: batch_tables[n] = previous.batch_tables[n]
+        data = {n: reused[n] if n in reused else fresh[n] for n in case_data}
+        snapshot = CatalogSnapshot(version, data, case_images, hashes, samplers, batch_tables)
+        snapshot.assets["case_list"] = self._format_case_list(data)
+        if previous:
+            # 封面图片地址未变的容器沿用已缩放好的封面；本方法在线程中执行，事件循环可能同时写入新封面，先取副本
+            for key, value in list(previous.assets.items()):
+                if key[0] == "cover" and previous.case_images.get(key[1]) == case_images.get(key[1]):
+                    snapshot.assets[key] = value
+        return snapshot
+
+    def _format_case_list(self, case_data):
+        if not case_data: return None
+        cases, souvenirs, collections = [], [], []
+        for n in sorted(case_data.keys()):
+            t = self._identify_container_type(n)
+            if t == "souvenir": souvenirs.append(n)
+            elif t == "collection": collections.append(n)
+            else: cases.append(n)
+        def fmt(items):
+            lines = []
+            for i in range(0, len(items), 2): lines.append(" | ".join(items[i:i+2]))
+            return "\n".join(lines) if items else "(无)"
+        return f"📦 武器箱 ({len(cases)}):\n{fmt(cases)}\n\n🎁 纪念包 ({len(souvenirs)}):\n{fmt(souvenirs)}\n\n🖼️ 收藏品 ({len(collections)}):\n{fmt(collections)}"
+
+    async def _case_cover(self, catalog, case_name):
+        """取缩放后的封面 PNG，按目录快照缓存；下载失败不缓存，下次重试"""
+        key = ("cover", case_name, self.COVER_WIDTH)
+        data = catalog.assets.get(key)
+        if data is not None: return data
+        url = catalog.case_images.get(case_name)
+        if not url: return None
+        img_obj = await self.img_mgr.get_image(url)
+        if img_obj is None: return None
+        data = await asyncio.to_thread(self._render_cover, img_obj)
+        catalog.assets[key] = data
+        return data
+
+    def _render_cover(self, img_obj):
+        w_percent = (self.COVER_WIDTH / float(img_obj.size[0]))
+        h_size = int((float(img_obj.size[1]) * float(w_percent)))
+        img_small = img_obj.resize((self.COVER_WIDTH, h_size), Image.Resampling.LANCZOS)
+        cover_buf = BytesIO()
+        img_small.save(cover_buf, format="PNG")
+        return cover_buf.getvalue()
+
     def _recalculate_probabilities(self, data):
+        """
+        计算单品概率，并为每个容器预建别名表抽样器
+        返回: {容器名: AliasSampler}
+        """
+        samplers = {}
         for case_name, items in data.items():
             prob_table = self._get_probability_map(items, case_name)
             quality_counts = {}
@@ -777,58 +2694,131 @@ class CasePlugin(Star):
                 if q in prob_table and quality_counts.get(q, 0) > 0:
                     item["probability"] = prob_table[q] / quality_counts[q]
                 else: item["probability"] = 0
+            valid_items = [i for i in items if i["probability"] > 0]
+            samplers[case_name] = AliasSampler(valid_items, [i["probability"] for i in valid_items])
+        return samplers
 
-    def _generate_item(self, case_name):
-        items = self.case_data.get(case_name, [])
-        valid_items = [i for i in items if i.get("probability", 0) > 0]
-        if not valid_items: return {"name": "错误", "quality": "军规级", "wear_value": 0, "wear_level": "无", "img": "", "rln": "军规级", "short_name": "错误"}
+    def _generate_item(self, case_name, catalog=None):
+        catalog = catalog or self.catalog
+        sampler = catalog.samplers.get(case_name)
+        if not sampler: return {"name": "错误", "quality": "军规级", "wear_value": 0, "wear_level": "无", "img": "", "rln": "军规级", "short_name": "错误"}
 
         ctype = self._identify_container_type(case_name)
-        rand = random.random()
-        cumulative = 0.0
-        selected_item = valid_items[-1]
-        
-        for item in valid_items:
-            cumulative += item["probability"]
-            if rand <= cumulative:
-                selected_item = item
-                break
-        
+        selected_item = sampler.sample()
         raw_name = selected_item["short_name"]
+
+        stattrak = ctype == "case" and "手套" not in raw_name and random.random() < 0.1
+        phase = None
+        if "多普勒" in raw_name:
+            phase = (GAMMA_DOPPLER_SAMPLER if "伽玛" in raw_name else NORMAL_DOPPLER_SAMPLER).sample()
+            chosen_level = DOPPLER_WEAR_SAMPLER.sample()
+        else:
+            chosen_level = WEAR_SAMPLER.sample()
+        wear_val = round(random.uniform(chosen_level[2], chosen_level[3]), 8)
+        return self._build_item(selected_item, ctype, stattrak, phase, chosen_level[0], wear_val)
+
+    def _build_item(self, case_item, ctype, stattrak, phase, wear_level, wear_val):
+        raw_name = case_item["short_name"]
         item_name = raw_name
-        quality = selected_item["rln"]
-        img = selected_item.get("img", "")
-        
+        quality = case_item["rln"]
+
         if ctype == "souvenir": item_name = f"纪念品 | {item_name}"
-        elif ctype == "case":
-            if "手套" not in item_name and random.random() < 0.1:
-                item_name = f"StatTrak™ | {item_name}"
-
-        is_doppler = "多普勒" in item_name
-        if is_doppler:
-            is_gamma = "伽玛" in item_name
-            type_pool = GAMMA_DOPPLER_PROBS if is_gamma else NORMAL_DOPPLER_PROBS
-            chosen_type = random.choices(list(type_pool.keys()), weights=list(type_pool.values()), k=1)[0]
-            item_name = item_name.replace("多普勒", f"多普勒 ({chosen_type})")
-
-        wear_config = DOPPLER_WEAR_LEVELS if is_doppler else WEAR_LEVELS
-        chosen_level = random.choices(wear_config, weights=[wl[1] for wl in wear_config], k=1)[0]
-        wear_val = round(random.uniform(chosen_level[2], chosen_level[3]), 8)
+        elif stattrak: item_name = f"StatTrak™ | {item_name}"
+        if phase: item_name = item_name.replace("多普勒", f"多普勒 ({phase})")
 
-        is_rare = quality in ["隐秘", "非凡", "Contraband"]
+        is_rare = quality in RARE_QUALITIES
 
         return {
             "name": item_name,
             "raw_name": raw_name,
             "quality": quality,
             "wear_value": wear_val,
-            "wear_level": chosen_level[0],
+            "wear_level": wear_level,
             "template_id": random.randint(0, 999),
-            "img": img,
+            "img": case_item.get("img", ""),
             "is_special": is_rare,
             "rln": quality
         }
 
+    def _get_batch_tables(self, catalog, case_name, sampler):
+        """按容器缓存批量抽样所需的逐物品属性数组"""
+        tables = catalog.batch_tables.get(case_name)
+        if tables and tables["sampler"] is sampler: return tables
+        entries = sampler.entries
+        ctype = self._identify_container_type(case_name)
+        qualities = []
+        for e in entries:
+            if e["rln"] not in qualities: qualities.append(e["rln"])
+        tables = {
+            "sampler": sampler,
+            "qualities": qualities,
+            "quality_idx": np.array([qualities.index(e["rln"]) for e in entries], dtype=np.intp),
+            "rare": np.array([e["rln"] in RARE_QUALITIES for e in entries], dtype=bool),
+            "stattrak_ok": np.array([ctype == "case" and "手套" not in e["short_name"] for e in entries], dtype=bool),
+            "doppler": np.array(["多普勒" in e["short_name"] for e in entries], dtype=bool),
+            "gamma": np.array(["伽玛" in e["short_name"] for e in entries], dtype=bool),
+        }
+        catalog.batch_tables[case_name] = tables
+        return tables
+
+    def generate_batch(self, case_name, n, display_limit=10, catalog=None):
+        """
+        批量开箱：整批一次性抽取物品下标、StatTrak、多普勒相位、磨损等级与磨损值，
+        只为需要展示 (n <= display_limit) 或作为稀有入库的物品构造 dict。
+        返回: {"count", "quality_counts", "display", "rare"}
+        """
+        catalog = catalog or self.catalog
+        sampler = catalog.samplers.get(case_name)
+        if np is None or not sampler or n <= 1:
+            items = [self._generate_item(case_name, catalog) for _ in range(n)]
+            quality_counts = {}
+            for item in items:
+                quality_counts[item["quality"]] = quality_counts.get(item["quality"], 0) + 1
+            return {
+                "count": n,
+                "quality_counts": quality_counts,
+                "display": items if n <= display_limit else [],
+                "rare": [i for i in items if i["is_special"]],
+            }
+
+        rng = self._np_rng
+        tables = self._get_batch_tables(catalog, case_name, sampler)
+        idx = sampler.sample_indices(n, rng)
+        stattrak = tables["stattrak_ok"][idx] & (rng.random(n) < 0.1)
+        doppler = tables["doppler"][idx]
+        gamma = tables["gamma"][idx]
+        normal_phase = NORMAL_DOPPLER_SAMPLER.sample_indices(n, rng)
+        gamma_phase = GAMMA_DOPPLER_SAMPLER.sample_indices(n, rng)
+        normal_tier = WEAR_SAMPLER.sample_indices(n, rng)
+        doppler_tier = DOPPLER_WEAR_SAMPLER.sample_indices(n, rng)
+        wear_lo = np.where(doppler, self._wear_bounds["doppler_lo"][doppler_tier], self._wear_bounds["lo"][normal_tier])
+        wear_hi = np.where(doppler, self._wear_bounds["doppler_hi"][doppler_tier], self._wear_bounds["hi"][normal_tier])
+        wear = np.round(wear_lo + (wear_hi - wear_lo) * rng.random(n), 8)
+
+        counts = np.bincount(tables["quality_idx"][idx], minlength=len(tables["qualities"]))
+        quality_counts = {q: int(c) for q, c in zip(tables["qualities"], counts) if c > 0}
+
+        rare_pos = np.flatnonzero(tables["rare"][idx]).tolist()
+        display_pos = list(range(n)) if n <= display_limit else []
+        ctype = self._identify_container_type(case_name)
+        built = {}
+        for pos in sorted(set(rare_pos) | set(display_pos)):
+            if doppler[pos]:
+                phase = (GAMMA_DOPPLER_SAMPLER if gamma[pos] else NORMAL_DOPPLER_SAMPLER).entries[
+                    int(gamma_phase[pos] if gamma[pos] else normal_phase[pos])]
+                level = DOPPLER_WEAR_LEVELS[int(doppler_tier[pos])][0]
+            else:
+                phase = None
+                level = WEAR_LEVELS[int(normal_tier[pos])][0]
+            built[pos] = self._build_item(sampler.entries[int(idx[pos])], ctype, bool(stattrak[pos]), phase, level, float(wear[pos]))
+
+        return {
+            "count": n,
+            "quality_counts": quality_counts,
+            "display": [built[p] for p in display_pos],
+            "rare": [built[p] for p in rare_pos],
+        }
+
     def _parse_command(self, msg: str) -> tuple:
         clean_msg = msg.replace("开箱", "", 1).strip()
         if not clean_msg:
@@ -856,6 +2846,7 @@ class CasePlugin(Star):
 
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent):
+        self._ensure_maintenance()
         msg = event.message_str.strip()
         if msg == "清除库存":
             async for r in self._handle_purge(event): yield r
@@ -865,41 +2856,325 @@ class CasePlugin(Star):
                 async for r in self._handle_clear_cache(event): yield r
             else:
                 yield event.plain_result("❌ 权限不足")
-        elif msg == "更新武器箱":
+        elif msg == "更新武器箱" or msg.startswith("更新武器箱 "):
             sender_id = str(event.get_sender_id())
             if sender_id in self.admins:
                 async for r in self._handle_update_cases(event): yield r
             else:
                 yield event.plain_result(f"❌ 权限不足：仅管理员可更新数据。")
+        elif msg == "预热缓存" or msg.startswith("预热缓存 "):
+            sender_id = str(event.get_sender_id())
+            if sender_id in self.admins:
+                async for r in self._handle_prewarm(event): yield r
+            else:
+                yield event.plain_result("❌ 权限不足")
+        elif msg == "渲染测试" or msg.startswith("渲染测试 "):
+            sender_id = str(event.get_sender_id())
+            if sender_id in self.admins:
+                async for r in self._handle_render_bench(event): yield r
+            else:
+                yield event.plain_result("❌ 权限不足")
+        elif msg == "开箱状态":
+            sender_id = str(event.get_sender_id())
+            if sender_id in self.admins:
+                async for r in self._handle_status(event): yield r
+            else:
+                yield event.plain_result("❌ 权限不足")
         elif msg == "开箱菜单":
             # [v4.4] 发送菜单图片
             img_bytes = self.gif_gen.generate_help_card()
-            yield event.chain_result([Comp.Image.fromBytes(img_bytes)])
+            yield event.chain_result([self.media.image(event, img_bytes, "menu.png")])
         elif msg == "武器箱列表":
             async for r in self._handle_show_list(event): yield r
         elif msg == "库存":
             async for r in self._show_inventory(event): yield r
         elif msg.startswith("开箱"):
-            async for r in self._handle_open(event): yield r
+            self._active_opens += 1
+            try:
+                async for r in self._handle_open(event): yield r
+            finally:
+                self._active_opens -= 1
         elif msg.startswith("查询价格"):
             async for r in self._handle_price_query(event): yield r
 
+    def _ensure_maintenance(self):
+        """首次收到消息时启动后台缓存维护任务 (插件初始化时不一定处于事件循环中)"""
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.ensure_future(self._maintenance_loop())
+
+    async def _maintenance_loop(self):
+        while True:
+            try:
+                await self.img_mgr.maintain(self.db_writer)
+                self.media.spool.reap()
+            except Exception as e:
+                print(f"缓存维护失败: {e}")
+            await asyncio.sleep(self.MAINTENANCE_INTERVAL)
+
+    async def terminate(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+        if self._prewarm_task is not None:
+            self._prewarm_task.cancel()
+        try:
+            await self.img_mgr.flush_index(self.db_writer)
+        except Exception as e:
+            print(f"图片缓存索引保存失败: {e}")
+        await self.db_writer.stop()
+        if self.render_pool is not None:
+            self.render_pool.close()
+        self.db.close()
+        await self.http.close()
+
+    def _status_lines(self):
+        db = self.db.pool.stats()
+        lines = [
+            "🗄️ 数据库连接池",
+            f"写: {db['write_count']} 次, 平均等待 {db['write_wait_avg_ms']:.2f}ms, 最长 {db['write_wait_max_ms']:.1f}ms",
+            f"读({db['readers']} 连接): {db['read_count']} 次, 平均等待 {db['read_wait_avg_ms']:.2f}ms, 最长 {db['read_wait_max_ms']:.1f}ms",
+            f"忙重试: {db['busy_retries']} 次, 失败: {db['busy_failures']} 次",
+            f"写入线程: {self.db_writer.metrics['jobs']} 个任务 / {self.db_writer.metrics['batches']} 次提交, "
+            f"最大批次 {self.db_writer.metrics['max_batch_seen']}, 失败 {self.db_writer.metrics['failed']}",
+        ]
+        price = self.price_svc.stats()
+        lines += [
+            "💰 价格查询",
+            f"缓存命中率: {price['hit_rate'] * 100:.1f}% (命中 {price['hits']}, 合并 {price['coalesced']}, 未命中 {price['misses']}, 条目 {price['entries']})",
+            f"上游请求: {price['upstream']} 次, 失败 {price['upstream_errors']}, 平均 {price['upstream_avg_ms']:.0f}ms, 最长 {price['upstream_max_ms']:.0f}ms",
+        ]
+        img = self.img_mgr.metrics
+        lines += [
+            "🖼️ 图片缓存",
+            f"下载: {img['downloads']} 次, 失败 {img['download_failures']}, 合并重复请求 {img['coalesced']}",
+        ]
+        disk = self.img_mgr.disk_stats()
+        cap = f"{disk['max_bytes'] / 1048576:.0f}MB" if disk['max_bytes'] else "不限"
+        lines.append(f"磁盘: {disk['files']} 个文件, {disk['bytes'] / 1048576:.1f}MB / {cap}, "
+                     f"已淘汰 {disk['evicted']} 个 ({disk['evicted_bytes'] / 1048576:.1f}MB)")
+        mem = self.img_mgr.memory.stats()
+        lines.append(f"内存: {mem['entries']} 张, {mem['bytes'] / 1048576:.1f}/{mem['max_bytes'] / 1048576:.0f}MB, "
+                     f"命中 {mem['hits']}, 未命中 {mem['misses']}, 淘汰 {mem['evictions']}")
+        media = self.media.stats()
+        tmp = media["spool"]
+        lines.append(f"输出({media['mode']}): 字节发送 {media['bytes']} 次, 文件发送 {media['files']} 次; "
+                     f"暂存文件存活 {tmp['live']} 个, 已回收 {tmp['reaped']}")
+        atlas = self.gif_gen.atlas_store.stats()
+        lines.append(f"图集: 内存 {atlas['in_memory']} 个, 命中 {atlas['hits']}, 磁盘载入 {atlas['loaded']}, "
+                     f"生成 {atlas['built']} (缺图 {atlas['incomplete']})")
+        if self._prewarm is not None:
+            if self._prewarm["state"] == "进行中":
+                lines.append(self._prewarm_progress())
+            else:
+                lines.append(f"🔥 预热{self._prewarm['state']}: {self._prewarm['done']}/{self._prewarm['total']}，缺图 {self._prewarm['failed']}，"
+                             f"写入图集 {self._prewarm_atlas_bytes() / 1048576:.1f}MB")
+        rs = self.render_scheduler.stats()
+        lines.append("🎞️ 渲染")
+        lines.append(f"调度: 进行中 {rs['running']}/{rs['max_concurrent']}, 排队 {rs['queued']}/{rs['max_waiting']}, "
+                     f"降级 {rs['degraded']} 次")
+        if rs["granted"]:
+            lines.append(f"排队: 平均 {rs['wait_ms'] / rs['granted']:.0f}ms, 最长 {rs['wait_max_ms']:.0f}ms; "
+                         f"渲染: 平均 {rs['render_ms'] / max(1, rs['renders']):.0f}ms")
+        for mode, label in (("template", "模板拼接"), ("fast", "快速编码"), ("legacy", "兼容编码")):
+            m = self.gif_gen.metrics[mode]
+            if not m["renders"]: continue
+            n = m["renders"]
+            lines.append(f"动图({label}): {n} 张, 平均合成 {m['compose_ms'] / n:.0f}ms, 编码 {m['encode_ms'] / n:.0f}ms, "
+                         f"{m['bytes'] / n / 1024:.0f}KB")
+        lines.append(f"输出档位: 默认 {self.render_profile}, 单独配置 {len(self.group_profiles)} 个群; "
+                     f"因排队降级 {self.profile_downgrades['wait']} 次, 因体积降级 {self.profile_downgrades['size']} 次")
+        for name, spec in GifGenerator.PROFILES.items():
+            m = self.gif_gen.profile_metrics[name]
+            if not m["renders"]: continue
+            n = m["renders"]
+            lines.append(f"档位({spec['label']}): {n} 次, 平均渲染 {m['render_ms'] / n:.0f}ms, "
+                         f"平均 {m['bytes'] / n / 1024:.0f}KB (近期 {m['avg_bytes'] / 1024:.0f}KB), 最大 {m['max_bytes'] / 1024:.0f}KB")
+        if self.gif_gen.templates is not None:
+            tm, tc = self.gif_gen.template_metrics, self.gif_gen.templates.stats()
+            avg = tm["build_ms"] / tm["built"] if tm["built"] else 0.0
+            lines.append(f"动画模板: {tc['entries']} 项, {tc['bytes'] / 1048576:.1f}/{tc['max_bytes'] / 1048576:.0f}MB, "
+                         f"生成 {tm['built']} 个 (平均 {avg:.0f}ms), 淘汰 {tc['evictions']}, 回退 {tm['fallbacks']}")
+        if self.render_pool is not None:
+            rp = self.render_pool.stats()
+            state = "已损坏，使用线程渲染" if rp["broken"] else f"排队 {rp['pending']}/{rp['max_queue']}"
+            lines.append(f"渲染进程: {rp['workers']} 个, {state}, 完成 {rp['jobs']}, 队列满回退 {rp['rejected']}, 失败 {rp['errors']}")
+        lines.append("🌐 HTTP 连接池")
+        for host, m in self.http.stats().items():
+            avg = m["ms"] / m["requests"] if m["requests"] else 0.0
+            lines.append(f"{host}: {m['requests']} 次, 重试 {m['retries']}, 失败 {m['errors']}, 平均 {avg:.0f}ms")
+        return lines
+
+    def _prewarm_progress(self):
+        st = self._prewarm
+        now = time.monotonic()
+        paused_s = st["paused_s"] + (now - st["paused_at"] if st["paused_at"] is not None else 0.0)
+        elapsed = now - st["started"] - paused_s
+        left = st["total"] - st["done"]
+        eta = left * elapsed / st["done"] if st["done"] else 0.0
+        paused = "，因开箱繁忙暂停中" if st["paused_at"] is not None else ""
+        return (f"🔥 预热进度 {st['done']}/{st['total']}，缺图 {st['failed']}，"
+                f"已写入图集 {self._prewarm_atlas_bytes() / 1048576:.1f}MB，{self._prewarm_disk_text()}，"
+                f"预计剩余 {eta / 60:.1f} 分钟{paused}")
+
+    def _prewarm_atlas_bytes(self):
+        return self.gif_gen.atlas_store.metrics["bytes_written"] - self._prewarm["atlas_bytes_start"]
+
+    def _prewarm_disk_text(self):
+        cap = self.img_mgr.max_disk_bytes
+        used = self.img_mgr.disk_bytes / 1048576
+        return f"磁盘缓存 {used:.0f}/{cap / 1048576:.0f}MB" if cap else f"磁盘缓存 {used:.0f}MB"
+
+    def _prewarm_disk_full(self):
+        """
+        磁盘缓存达到上限后继续预热只会挤掉刚写入的文件
+        淘汰会把缓存降到上限的 EVICT_LOW_WATERMARK，这是缓存的常态，因此以上限本身为准
+        """
+        cap = self.img_mgr.max_disk_bytes
+        return cap > 0 and self.img_mgr.disk_bytes >= cap
+
+    async def _handle_prewarm(self, event):
+        arg = event.message_str.strip()[len("预热缓存"):].strip()
+        running = self._prewarm_task is not None and not self._prewarm_task.done()
+        if arg == "停止":
+            if running:
+                self._prewarm_task.cancel()
+                yield event.plain_result("⏹️ 已停止预热")
+            else:
+                yield event.plain_result("当前没有进行中的预热任务")
+            return
+        if running:
+            yield event.plain_result(self._prewarm_progress())
+            return
+        catalog = self.catalog
+        if not catalog.case_data:
+            yield event.plain_result("❌ 无数据，请先更新")
+            return
+        if self._prewarm_disk_full():
+            yield event.plain_result(f"⚠️ 磁盘缓存已达到 image_cache_max_mb 上限 ({self._prewarm_disk_text()})，"
+                                     f"预热会挤掉已有缓存，未启动。可调大上限或发送“清除缓存”后重试。")
+            return
+        self._prewarm = {"total": len(catalog.case_data), "done": 0, "failed": 0,
+                         "started": time.monotonic(), "paused_s": 0.0, "paused_at": None, "state": "进行中",
+                         "atlas_bytes_start": self.gif_gen.atlas_store.metrics["bytes_written"]}
+        self._prewarm_task = asyncio.ensure_future(self._run_prewarm(event.unified_msg_origin, catalog))
+        concurrency = self._safe_int(self.config.get("prewarm_concurrency", 2), 2, minimum=1)
+        yield event.plain_result(f"🔥 开始在后台预热 {len(catalog.case_data)} 个容器的图片缓存 (并发 {concurrency})，"
+                                 f"开箱繁忙时会自动暂停。发送“预热缓存”查看进度，“预热缓存 停止”中止。")
+
+    def _open_traffic_high(self):
+        return self._active_opens >= self.PREWARM_PAUSE_OPENS or self.render_scheduler.stats()["queued"] > 0
+
+    async def _prewarm_wait_idle(self):
+        st = self._prewarm
+        while self._open_traffic_high():
+            if st["paused_at"] is None: st["paused_at"] = time.monotonic()
+            await asyncio.sleep(1)
+        if st["paused_at"] is not None:
+            st["paused_s"] += time.monotonic() - st["paused_at"]
+            st["paused_at"] = None
+
+    async def _run_prewarm(self, umo, catalog):
+        """逐个容器下载缺失的物品图与封面，并生成条带图集与缩放封面"""
+        st = self._prewarm
+        names = iter(list(catalog.case_data))
+
+        async def worker():
+            for name in names:
+                await self._prewarm_wait_idle()
+                if self._prewarm_disk_full():
+                    st["disk_full"] = True
+                    return
+                try:
+                    atlas = await self.gif_gen.atlas_store.get(catalog.hashes.get(name), catalog.case_data[name])
+                    cover_ok = await self._case_cover(catalog, name) is not None or not catalog.case_images.get(name)
+                    if not atlas.complete or not cover_ok: st["failed"] += 1
+                except Exception as e:
+                    print(f"预热 {name} 失败: {e}")
+                    st["failed"] += 1
+                st["done"] += 1
+
+        concurrency = self._safe_int(self.config.get("prewarm_concurrency", 2), 2, minimum=1)
+        tasks = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        try:
+            while True:
+                done, _ = await asyncio.wait(tasks, timeout=self.PREWARM_REPORT_INTERVAL)
+                if len(done) == len(tasks): break
+                await self.context.send_message(umo, MessageChain().message(self._prewarm_progress()))
+            elapsed = time.monotonic() - st["started"]
+            summary = (f"{st['done']}/{st['total']} 个容器，缺图 {st['failed']} 个，"
+                       f"写入图集 {self._prewarm_atlas_bytes() / 1048576:.1f}MB，{self._prewarm_disk_text()}，"
+                       f"耗时 {elapsed / 60:.1f} 分钟 (其中因开箱繁忙暂停 {st['paused_s'] / 60:.1f} 分钟)")
+            if st.get("disk_full"):
+                st["state"] = "因磁盘缓存达到上限停止"
+                await self.context.send_message(umo, MessageChain().message(
+                    f"⚠️ 磁盘缓存已达到 image_cache_max_mb 上限，预热提前停止：{summary}"))
+            else:
+                st["state"] = "已完成"
+                await self.context.send_message(umo, MessageChain().message(f"✅ 预热完成：{summary}"))
+        except asyncio.CancelledError:
+            st["state"] = "已停止"
+            raise
+        except Exception as e:
+            st["state"] = "失败"
+            print(f"预热任务异常: {e}")
+        finally:
+            for t in tasks: t.cancel()
+
+    async def _handle_status(self, event):
+        yield event.plain_result("\n".join(self._status_lines()))
+
     async def _handle_clear_cache(self, event):
         try:
-            count = 0
-            if os.path.exists(IMAGES_DIR):
-                count = len(os.listdir(IMAGES_DIR))
-                shutil.rmtree(IMAGES_DIR) 
-            os.makedirs(IMAGES_DIR, exist_ok=True) 
+            count = await self.img_mgr.clear_disk(self.db_writer)
+            self.gif_gen.atlas_store.clear()
             yield event.plain_result(f"✅ 缓存已清除！释放了 {count} 个文件。\n下次开箱将会重新下载图片。")
         except Exception as e:
             yield event.plain_result(f"❌ 清除失败: {e}")
 
+    def _api_rate(self) -> float:
+        try:
+            interval = float(self.config.get("api_request_interval", 1.5))
+        except Exception:
+            interval = 1.5
+        return 1.0 / max(0.05, interval)
+
+    @staticmethod
+    def _fingerprint_hash(obj):
+        return hashlib.sha1(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _list_updated_field(entry):
+        for key in ("updated_at", "update_time", "updatedAt", "last_update"):
+            if entry.get(key): return str(entry[key])
+        return None
+
+    def _clean_container_detail(self, raw):
+        cleaned = []
+        seen = set()
+        for item in raw:
+            rln = item.get("rln")
+            s_name = item.get("short_name")
+            if rln not in ALL_QUALITIES: continue
+            if s_name in seen: continue
+            if "（★）" in s_name: rln = "非凡"
+            seen.add(s_name)
+            cleaned.append({"short_name": s_name, "rln": rln, "img": item.get("img")})
+        return cleaned
+
     async def _handle_update_cases(self, event: AstrMessageEvent):
-        yield event.plain_result("⏳ 开始同步数据 (限制频率 1.5s/次)...")
-        url = f"https://{self.api_host}/api/v1/info/container_data_info"
+        if self._sync_lock.locked():
+            yield event.plain_result("⏳ 已有同步任务在进行中，请稍后")
+            return
+        full = "--full" in event.message_str.split()
+        async with self._sync_lock:
+            async for r in self._run_update_cases(event, full): yield r
+
+    async def _run_update_cases(self, event, full=False):
+        limiter = self.api_limiter
+        concurrency = self._safe_int(self.config.get("sync_concurrency", 3), 3, minimum=1)
+        url = f"{self.api_base}/api/v1/info/container_data_info"
         try:
-            list_resp = self.net_mgr.request(url, method="POST")
+            await limiter.acquire()
+            list_resp = await self.net_mgr.request(url, "POST")
         except Exception as e:
             yield event.plain_result(f"❌ 列表请求异常: {e}")
             return
@@ -907,68 +3182,138 @@ class CasePlugin(Star):
         if not list_resp or list_resp.get("code") != 200:
             yield event.plain_result(f"❌ 获取列表失败: {list_resp}")
             return
-        
-        containers = list_resp.get("data", [])
-        total = len(containers)
+
+        targets = []
+        for c in list_resp.get("data", []):
+            name = c['name']
+            if any(k in name for k in ["胶囊", "涂鸦", "布章"]): continue
+            if name.endswith("挂件") or name.endswith("印花"): continue
+            targets.append(c)
+
+        checkpoint = await asyncio.to_thread(self.db.load_sync_checkpoint)
+        await self.db_writer.submit(self.db.begin_sync_tx, bool(checkpoint))
+        # 全量同步不按指纹跳过，但仍用旧的详情哈希区分“重新拉取但内容未变”与真正变更的容器
+        known_fingerprints = await asyncio.to_thread(self.db.load_fingerprints)
+        fingerprints = {} if full else known_fingerprints
+        catalog = self.catalog
+        fetched = {}
+        skipped_ids = set()
+        pending = []
+        for c in targets:
+            cid = str(c['id'])
+            list_hash = self._fingerprint_hash(c)
+            if cid in checkpoint and checkpoint[cid][3] == list_hash:
+                fetched[cid] = checkpoint[cid]
+                continue
+            fp = fingerprints.get(cid)
+            if fp and fp["list_hash"] == list_hash and fp["name"] == c['name']:
+                known = catalog.case_data.get(c['name'], [])
+                if len(known) == fp["item_count"]:
+                    items = [{"short_name": i["short_name"], "rln": i["rln"], "img": i.get("img")} for i in known]
+                    fetched[cid] = (c['name'], c.get("img") or "", items, list_hash)
+                    skipped_ids.add(cid)
+                    continue
+            pending.append(c)
+        total = len(targets)
+        skipped = len(skipped_ids)
+        resumed = total - len(pending) - skipped
+        eta = len(pending) / limiter.rate
+        tip = f"，从断点继续 (已完成 {resumed})" if resumed else ""
+        mode = "全量同步" if full else f"增量同步，未变化跳过 {skipped} 个"
+        yield event.plain_result(
+            f"⏳ 开始{mode}，共 {total} 个容器{tip}\n需拉取 {len(pending)} 个，并发 {concurrency}，"
+            f"限速 {limiter.rate:.2f} 次/秒，预计 {eta / 60:.1f} 分钟")
+
+        failures = []
+        work = asyncio.Queue()
+        for c in pending: work.put_nowait(c)
+
+        async def worker():
+            while True:
+                try:
+                    c = work.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                detail_url = f"{self.api_base}/api/v1/info/good/container_detail?id={c['id']}"
+                try:
+                    await limiter.acquire()
+                    detail = await self.net_mgr.request(detail_url)
+                    if not detail or detail.get("code") != 200:
+                        raise RuntimeError(f"code={detail.get('code') if detail else None}")
+                    cleaned = self._clean_container_detail(detail.get("data", []))
+                    entry = (c['name'], c.get("img") or "", cleaned, self._fingerprint_hash(c))
+                    await self.db_writer.submit(self.db.save_sync_checkpoint_tx, c['id'], *entry)
+                    fetched[str(c['id'])] = entry
+                except Exception as e:
+                    failures.append((c['name'], str(e)))
+
+        started = time.monotonic()
+        tasks = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(pending)) or 1)]
+        progress_interval = 30
+        try:
+            while True:
+                done, _ = await asyncio.wait(tasks, timeout=progress_interval)
+                if len(done) == len(tasks): break
+                finished = len(fetched) - resumed - skipped + len(failures)
+                elapsed = time.monotonic() - started
+                left = len(pending) - finished
+                eta = left * elapsed / finished if finished else left / limiter.rate
+                yield event.plain_result(
+                    f"🔄 同步进度 {len(fetched) + len(failures)}/{total}，失败 {len(failures)}，预计剩余 {eta / 60:.1f} 分钟")
+        finally:
+            for t in tasks: t.cancel()
+
+        if failures:
+            sample = "；".join(f"{n}({e})" for n, e in failures[:3])
+            yield event.plain_result(
+                f"⚠️ {len(failures)} 个容器拉取失败: {sample}\n已完成的 {len(fetched)} 个已保存断点，再次发送“更新武器箱”将从断点继续")
+            return
+
         new_cases = {}
         new_imgs = {}
-        success = 0
-        
+        new_fingerprints = {}
+        refetched_same = 0
+        list_entries = {str(c['id']): c for c in targets}
+        for cid, (name, img, items, list_hash) in fetched.items():
+            if img: new_imgs[name] = img
+            if items: new_cases[name] = items
+            detail_hash = self._fingerprint_hash(items)
+            old = known_fingerprints.get(cid)
+            if cid not in skipped_ids and old and old["detail_hash"] == detail_hash:
+                refetched_same += 1
+            new_fingerprints[cid] = {
+                "name": name, "list_hash": list_hash, "detail_hash": detail_hash,
+                "item_count": len(items), "updated_field": self._list_updated_field(list_entries.get(cid, {})),
+            }
+        success = len(new_cases)
         try:
-            for idx, c in enumerate(containers):
-                name = c['name']
-                if any(k in name for k in ["胶囊", "涂鸦", "布章"]): continue
-                if name.endswith("挂件") or name.endswith("印花"): continue
-                
-                if c.get("img"): new_imgs[name] = c['img']
-                detail_url = f"https://{self.api_host}/api/v1/info/good/container_detail?id={c['id']}"
-                detail = self.net_mgr.request(detail_url)
-
-                if detail and detail.get("code") == 200:
-                    raw = detail.get("data", [])
-                    cleaned = []
-                    seen = set()
-                    for item in raw:
-                        rln = item.get("rln")
-                        s_name = item.get("short_name")
-                        if rln not in ALL_QUALITIES: continue
-                        if s_name in seen: continue
-                        if "（★）" in s_name: rln = "非凡"
-                        seen.add(s_name)
-                        cleaned.append({"short_name": s_name, "rln": rln, "img": item.get("img")})
-                    if cleaned:
-                        new_cases[name] = cleaned
-                        success += 1
-                
-                if idx % 10 == 0: print(f"同步: {idx}/{total}")
-                await asyncio.sleep(1.5)
-                
-            if self.db.save_all_data(new_cases, new_imgs):
-                self.case_data, self.case_images, self.item_img_map = self.db.load_all_data()
-                self._recalculate_probabilities(self.case_data)
-                yield event.plain_result(f"✅ 更新完毕！收录 {success} 个容器。")
-            else:
-                yield event.plain_result("❌ 数据库写入失败")
+            result = await self.db_writer.submit(self.db.sync_catalog_tx, new_cases, new_imgs)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
-            yield event.plain_result(f"❌ 中断: {e}")
+            print(f"保存失败: {e}")
+            yield event.plain_result("❌ 数据库写入失败")
+            return
+        try:
+            await self.db_writer.submit(self.db.finish_sync_tx, new_fingerprints)
+            self.catalog = await asyncio.to_thread(
+                self._build_catalog, result["version"], new_cases, dict(new_imgs), result["hashes"], self.catalog)
+            self.gif_gen.atlas_store.prune(result["hashes"].values())
+        except Exception as e:
+            print(f"目录快照更新失败: {e}")
+            yield event.plain_result(f"⚠️ 数据已写入数据库 (目录版本 v{result['version']})，但内存目录刷新失败: {e}\n请重新发送“更新武器箱”或重启插件")
+            return
+        yield event.plain_result(
+            f"✅ 更新完毕！收录 {success} 个容器 (目录版本 v{result['version']})，耗时 {(time.monotonic() - started) / 60:.1f} 分钟。\n"
+            f"API 请求 {len(pending) + 1} 次，跳过未变化 {skipped} 个，重新拉取但内容未变 {refetched_same} 个。\n"
+            f"新增 {len(result['inserted'])} | 变更 {len(result['changed'])} | "
+            f"移除 {len(result['removed'])} | 未变 {result['unchanged']}"
+            + ("\n可发送“预热缓存”提前下载新容器的图片。" if result['inserted'] or result['changed'] else ""))
 
     async def _handle_show_list(self, event):
-        if not self.case_data:
+        text = self.catalog.assets.get("case_list")
+        if not text:
             yield event.plain_result("❌ 无数据，请先更新")
             return
-        cases, souvenirs, collections = [], [], []
-        for n in sorted(self.case_data.keys()):
-            t = self._identify_container_type(n)
-            if t == "souvenir": souvenirs.append(n)
-            elif t == "collection": collections.append(n)
-            else: cases.append(n)
-        def fmt(items):
-            lines = []
-            for i in range(0, len(items), 2): lines.append(" | ".join(items[i:i+2]))
-            return "\n".join(lines) if items else "(无)"
-        yield event.plain_result(f"📦 武器箱 ({len(cases)}):\n{fmt(cases)}\n\n🎁 纪念包 ({len(souvenirs)}):\n{fmt(souvenirs)}\n\n🖼️ 收藏品 ({len(collections)}):\n{fmt(collections)}")
+        yield event.plain_result(text)
 
     async def _handle_open(self, event: AstrMessageEvent):
         msg = event.message_str.strip()
@@ -983,11 +3328,12 @@ class CasePlugin(Star):
             yield event.plain_result(f"❌ 单次开箱上限为 {max_per_request}，请调整数量")
             return
 
+        catalog = self.catalog
         target_case = None
-        if case_name in self.case_data:
+        if case_name in catalog.case_data:
             target_case = case_name
         else:
-            for name in self.case_data.keys():
+            for name in catalog.case_data.keys():
                 if case_name in name:
                     target_case = name
                     break
@@ -1004,13 +3350,13 @@ class CasePlugin(Star):
         now_text = now_dt.strftime("%Y-%m-%d %H:%M:%S")
 
         count = requested_count
-        allowed_count, used_today, remaining_today = self.db.consume_daily_quota(
-            user_key=user_key,
-            period_key=period_key,
-            request_count=count,
-            daily_limit=max_per_day,
-            now_text=now_text,
+        display_limit = self._display_limit()
+        allowed_count, used_today, remaining_today, batch = await self.db_writer.submit(
+            self.db.open_with_quota_tx, user_key, period_key, count, max_per_day, now_text,
+            lambda n: self.generate_batch(target_case, n, display_limit, catalog),
         )
+        if allowed_count > 0:
+            self._bump_inventory(user_key)
 
         if allowed_count <= 0:
             if max_per_day > 0:
@@ -1025,44 +3371,31 @@ class CasePlugin(Star):
 
         count = allowed_count
 
-        items_res = []
-        for _ in range(count):
-            item = self._generate_item(target_case)
-            items_res.append(item)
-            self.db.add_item(user_key, item)
 
-        user_stats = self.db.get_user_stats(user_key)
-        total_count = user_stats['total']
+        total_count = await asyncio.to_thread(self.db.get_user_total, user_key)
 
         if count == 1:
-            winner = items_res[0]
+            winner = batch["display"][0]
             chain = [Comp.At(qq=user_id)]
             chain.append(Comp.Plain(f" 【{target_case}】开启结果\n"))
 
-            case_img_url = self.case_images.get(target_case)
-            if case_img_url:
-                try:
-                    img_obj = await self.img_mgr.get_image(case_img_url)
-                    if img_obj:
-                        base_width = 180
-                        w_percent = (base_width / float(img_obj.size[0]))
-                        h_size = int((float(img_obj.size[1]) * float(w_percent)))
-                        img_small = img_obj.resize((base_width, h_size), Image.Resampling.LANCZOS)
-
-                        temp_cover_path = os.path.join(IMAGES_DIR, f"cover_{user_id}.png")
-                        img_small.save(temp_cover_path)
-                        chain.append(Comp.Image.fromFileSystem(temp_cover_path))
-                except Exception as e:
-                    print(f"封面图处理失败: {e}")
+            try:
+                cover = await self._case_cover(catalog, target_case)
+                if cover:
+                    chain.append(self.media.image(event, cover, "cover.png"))
+            except Exception as e:
+                print(f"封面图处理失败: {e}")
 
             try:
-                all_possible_items = self.case_data[target_case]
-                gif_bytes = await self.gif_gen.generate(winner, all_possible_items)
+                result = await self._open_animation(group_id, "开箱动图", winner, catalog, target_case)
 
-                temp_gif_path = os.path.join(IMAGES_DIR, f"temp_{user_id}.gif")
-                with open(temp_gif_path, "wb") as f:
-                    f.write(gif_bytes)
-                chain.append(Comp.Image.fromFileSystem(temp_gif_path))
+                if result is None:
+                    # 渲染排队已满，降级为静态结果
+                    if winner.get("img"):
+                        chain.append(Comp.Image.fromURL(winner["img"]))
+                    chain.append(Comp.Plain(self.DEGRADED_NOTICE))
+                else:
+                    chain.append(self.media.image(event, result[0], f"open.{result[1]}"))
             except Exception as e:
                 print(f"GIF生成失败: {e}")
                 if winner.get("img"):
@@ -1087,7 +3420,7 @@ class CasePlugin(Star):
             best_score = -1
             score_map = {"非凡": 10, "Contraband": 9, "隐秘": 8}
 
-            for item in items_res:
+            for item in batch["rare"]:
                 score = score_map.get(item['quality'], 0)
                 if score > best_score:
                     best_score = score
@@ -1096,32 +3429,31 @@ class CasePlugin(Star):
             if best_item and best_score > 0:
                 chain.append(Comp.Plain(" ✨ 欧气爆发！开出了稀有物品！\n"))
                 try:
-                    all_possible_items = self.case_data[target_case]
-                    gif_bytes = await self.gif_gen.generate(best_item, all_possible_items)
-                    temp_gif_path = os.path.join(IMAGES_DIR, f"temp_rare_{user_id}.gif")
-                    with open(temp_gif_path, "wb") as f:
-                        f.write(gif_bytes)
-                    chain.append(Comp.Image.fromFileSystem(temp_gif_path))
+                    result = await self._open_animation(group_id, "稀有动图", best_item, catalog, target_case)
+                    if result is None:
+                        chain.append(Comp.Plain(self.DEGRADED_NOTICE.strip() + "\n"))
+                    else:
+                        chain.append(self.media.image(event, result[0], f"rare.{result[1]}"))
                 except:
                     pass
 
             chain.append(Comp.Plain(f" ⚡ 开启【{target_case}】x{count}\n"))
-            if count <= 10:
-                for item in items_res:
-                    if item.get("img"):
+            ctype = self._identify_container_type(target_case)
+            if count <= display_limit:
+                display = batch["display"]
+                collage = await self._result_collage(
+                    event, group_id, display, [i['quality'] in RARE_QUALITIES for i in display], ctype != "capsule")
+                if collage: chain.append(collage)
+                for item in display:
+                    if not collage and item.get("img"):
                         chain.append(Comp.Image.fromURL(item["img"]))
                     info = f"🎁 {item['name']} ({item['quality']})\n"
-                    ctype = self._identify_container_type(target_case)
                     if ctype != "capsule":
                         info += f"🔧 {item['wear_level']} ({item['wear_value']:.5f})\n"
                     chain.append(Comp.Plain(info))
             else:
-                stats = {}
-                rare = []
-                for item in items_res:
-                    stats[item['quality']] = stats.get(item['quality'], 0) + 1
-                    if item.get("is_special") or item['quality'] in ["隐秘", "非凡", "Contraband"]:
-                        rare.append(item)
+                stats = batch["quality_counts"]
+                rare = batch["rare"]
 
                 chain.append(Comp.Plain("\n📊 统计结果：\n"))
                 for q, c in stats.items():
@@ -1129,11 +3461,13 @@ class CasePlugin(Star):
 
                 if rare:
                     chain.append(Comp.Plain("\n💎 稀有掉落：\n"))
+                    collage = await self._result_collage(
+                        event, group_id, rare, [i is best_item for i in rare], ctype != "capsule")
+                    if collage: chain.append(collage)
                     for item in rare:
-                        if item.get("img"):
+                        if not collage and item.get("img"):
                             chain.append(Comp.Image.fromURL(item["img"]))
                         chain.append(Comp.Plain(f"▸ {item['name']}\n"))
-                        ctype = self._identify_container_type(target_case)
                         if ctype != "capsule":
                             chain.append(Comp.Plain(f"   🔧 {item['wear_level']} ({item['wear_value']:.5f})\n"))
             chain.append(Comp.Plain(f"\n📦 总库存: {total_count}"))
@@ -1143,71 +3477,164 @@ class CasePlugin(Star):
                 chain.append(Comp.Plain(f"\n提示: {'；'.join(limit_msgs)}"))
             yield event.chain_result(chain)
 
+    async def _result_collage(self, event, group_id, items, highlights, show_wear):
+        """批量结果拼图；失败或渲染排队已满时返回 None，由调用方逐张发送图片链接"""
+        if not items: return None
+        try:
+            data = await self._scheduled_render(group_id, "结果拼图", lambda _: self.gif_gen.generate_result_collage(
+                items, highlights, show_wear))
+        except Exception as e:
+            print(f"结果拼图生成失败: {e}")
+            return None
+        if data is None: return None
+        return self.media.image(event, data, "collage.png")
+
+    async def _scheduled_render(self, group_id, kind, render, record=True):
+        """
+        经渲染调度执行 render(排队秒数)，记录排队与渲染耗时；排队已满时返回 None，由调用方发送静态结果
+        record=False 时只占用渲染名额，不计入统计
+        """
+        wait = await self.render_scheduler.acquire(group_id)
+        if wait is None: return None
+        started = time.perf_counter()
+        try:
+            return await render(wait)
+        finally:
+            self.render_scheduler.release()
+            if record: self.render_scheduler.record(group_id, kind, wait, time.perf_counter() - started)
+
+    def _pick_render_profile(self, group_id, wait):
+        """
+        按群配置取输出档位；排队耗时或该档位近期的平均体积超出预算时逐级降级
+        因体积降级的档位每隔 PROFILE_STALE_S 放行一次试探渲染，旧均值过期后以新样本重新判断，档位得以恢复
+        """
+        name = self.group_profiles.get(group_id, self.render_profile)
+        if self.render_wait_budget > 0:
+            for _ in range(int(wait // self.render_wait_budget)):
+                fallback = GifGenerator.PROFILES[name]["fallback"]
+                if fallback is None: break
+                name = fallback
+                self.profile_downgrades["wait"] += 1
+        while self.render_size_budget > 0:
+            m = self.gif_gen.profile_metrics[name]
+            fallback = GifGenerator.PROFILES[name]["fallback"]
+            if fallback is None or m["renders"] < self.PROFILE_MIN_SAMPLES or m["avg_bytes"] <= self.render_size_budget:
+                break
+            now = time.monotonic()
+            if now - max(m["last"], self._profile_probes.get(name, 0.0)) >= GifGenerator.PROFILE_STALE_S:
+                self._profile_probes[name] = now
+                break
+            name = fallback
+            self.profile_downgrades["size"] += 1
+        return name
+
+    async def _open_animation(self, group_id, kind, winner, catalog, case_name):
+        """渲染开箱动画，返回 (数据, 扩展名)；排队已满时返回 None"""
+        async def render(wait):
+            profile = self._pick_render_profile(group_id, wait)
+            data = await self.gif_gen.generate(
+                winner, catalog.case_data[case_name], atlas_key=catalog.hashes.get(case_name), profile=profile)
+            return data, GifGenerator.PROFILES[profile]["ext"]
+        return await self._scheduled_render(group_id, kind, render)
+
+    async def _handle_render_bench(self, event):
+        arg = event.message_str.strip()[len("渲染测试"):].strip()
+        catalog = self.catalog
+        if arg and arg not in catalog.case_data:
+            yield event.plain_result(f"❌ 未找到武器箱: {arg}")
+            return
+        if not catalog.case_data:
+            yield event.plain_result("❌ 暂无武器箱数据，请先更新武器箱")
+            return
+        case_name = arg or random.choice(list(catalog.case_data))
+        items = catalog.case_data[case_name]
+        sample = random.choice(items)
+        winner = dict(sample, name=sample.get("short_name", "???"))
+        group_id = str(event.message_obj.group_id)
+        lines = [f"🎬 渲染测试【{case_name}】{winner['name']} ({winner.get('rln')})"]
+        for name in GifGenerator.available_profiles():
+            started = time.perf_counter()
+            data = await self._scheduled_render(group_id, "渲染测试", lambda _: self.gif_gen.generate(
+                winner, items, atlas_key=catalog.hashes.get(case_name), profile=name, record=False), record=False)
+            label = GifGenerator.PROFILES[name]["label"]
+            if data is None:
+                lines.append(f"{label}({name}): 渲染排队已满，跳过")
+                continue
+            lines.append(f"{label}({name}): {len(data) / 1024:.0f}KB, {(time.perf_counter() - started) * 1000:.0f}ms")
+        if not WEBP_SUPPORTED:
+            lines.append("WebP: 当前 Pillow 不支持，已跳过")
+        lines.append("首次渲染含图集与模板生成耗时；测试渲染不计入统计，长期平均见“开箱状态”")
+        yield event.plain_result("\n".join(lines))
+
     async def _handle_purge(self, event):
         uid = f"{event.message_obj.group_id}-{event.get_sender_id()}"
-        self.db.clear_user_history(uid)
+        await self.db_writer.submit(self.db.clear_user_history_tx, uid)
+        self._bump_inventory(uid)
         yield event.plain_result("✅ 库存已清空")
 
+    def _bump_inventory(self, user_key):
+        """库存写入或清空后丢弃缓存的库存卡片，正在渲染的卡片完成后也不再缓存"""
+        self._inventory_cards.pop(user_key, None)
+        if user_key in self._inventory_rendering:
+            self._inventory_rendering[user_key] = True
+
     async def _show_inventory(self, event):
-        uid = f"{event.message_obj.group_id}-{event.get_sender_id()}"
-        inv = self.db.get_user_stats(uid)
+        group_id = str(event.message_obj.group_id)
+        uid = f"{group_id}-{event.get_sender_id()}"
+        cached = self._inventory_cards.get(uid)
+        if cached is not None:
+            self._inventory_cards.move_to_end(uid)
+            yield event.chain_result([Comp.At(qq=event.get_sender_id()), self.media.image(event, cached, "inventory.png")])
+            return
+        # 须在读取库存之前登记，读取或渲染期间有新写入时结果不进入缓存
+        first = uid not in self._inventory_rendering
+        if first: self._inventory_rendering[uid] = False
+        try:
+            async for r in self._render_inventory(event, group_id, uid, first): yield r
+        finally:
+            if first: self._inventory_rendering.pop(uid, None)
+
+    async def _render_inventory(self, event, group_id, uid, cacheable):
+        inv = await asyncio.to_thread(self.db.get_user_stats, uid)
         
         if inv['total'] == 0: 
             yield event.plain_result("📭 空空如也")
             return
             
         try:
-            img_bytes = await self.gif_gen.generate_inventory_card(inv, self.item_img_map)
-            temp_path = os.path.join(IMAGES_DIR, f"inv_{uid}.png")
-            with open(temp_path, "wb") as f: f.write(img_bytes)
-            yield event.chain_result([Comp.At(qq=event.get_sender_id()), Comp.Image.fromFileSystem(temp_path)])
+            img_bytes = await self._scheduled_render(group_id, "库存卡片", lambda _: self.gif_gen.generate_inventory_card(
+                inv, self.catalog.item_img_map))
+            if img_bytes is not None:
+                if cacheable and not self._inventory_rendering.get(uid):
+                    self._inventory_cards[uid] = img_bytes
+                    while len(self._inventory_cards) > self.INVENTORY_CARD_CACHE_SIZE:
+                        self._inventory_cards.popitem(last=False)
+                yield event.chain_result([Comp.At(qq=event.get_sender_id()), self.media.image(event, img_bytes, "inventory.png")])
+                return
         except Exception as e:
             print(f"库存图片生成失败: {e}")
             import traceback
             traceback.print_exc()
-            msg = [f"📦 总数: {inv['total']}", "---"]
-            for k,v in inv['other_stats'].items(): msg.append(f"{k}: {v}")
-            if inv['items']:
-                msg.append("\n💎 最近稀有:")
-                for item in inv['items']: msg.append(f"* {item['name']}")
-            yield event.plain_result("\n".join(msg))
+        # 渲染失败或渲染排队已满时发送文字库存
+        msg = [f"📦 总数: {inv['total']}", "---"]
+        for k,v in inv['other_stats'].items(): msg.append(f"{k}: {v}")
+        if inv['items']:
+            msg.append("\n💎 最近稀有:")
+            for item in inv['items']: msg.append(f"* {item['name']}")
+        yield event.plain_result("\n".join(msg))
 
     async def _show_menu(self, event):
         # 菜单图片
         img_bytes = self.gif_gen.generate_help_card()
-        yield event.chain_result([Comp.Image.fromBytes(img_bytes)])
-
-    def _http_request(self, path, method="GET"):
-        return self.net_mgr.request(f"https://{self.api_host}{path}", method=method)
-    
-    def search_items(self, keyword):
-        d = self._http_request(f"/api/v1/search/suggest?text={quote(keyword)}")
-        return d.get('data', []) if d and d.get('code')==200 else None
-
-    def get_goods_info(self, gid):
-        time.sleep(1.5)
-        d = self._http_request(f"/api/v1/info/good?id={gid}")
-        if not d or d.get('code')!=200: return None
-        g = d['data']['goods_info']
-        return {
-            "名称": g['name'], 
-            "BUFF": g['buff_sell_price'], 
-            "YYYP": g.get('yyyp_sell_price', '无'),
-            "Steam": g['steam_sell_price'], 
-            "img": g['img'], 
-            "更新": g['updated_at']
-        }
-
-    def get_price(self, name):
-        items = self.search_items(name)
-        if not items: return "❌ 未找到"
-        info = self.get_goods_info(items[0]['id'])
-        if not info: return "❌ 详情获取失败"
-        return f"{info['img']}\n{info['名称']}\nBUFF: {info['BUFF']} | YYYP: {info['YYYP']}\nSteam: {info['Steam']}"
+        yield event.chain_result([self.media.image(event, img_bytes, "menu.png")])
 
     async def _handle_price_query(self, event):
         name = event.message_str.replace("查询价格","").strip()
-        res = self.get_price(name)
+        try:
+            res = await self.price_svc.get_price(name)
+        except Exception as e:
+            yield event.plain_result(f"❌ 查询失败: {e}")
+            return
         if "http" in res:
             p = res.split('\n',1)
             yield event.chain_result([Comp.At(qq=event.get_sender_id()), Comp.Image.fromURL(p[0]), Comp.Plain("\n"+p[1])])
@@ -0,0 +1,215 @@
+"""
+“更新武器箱” 同步与价格查询的回归测试
+
+用 aiohttp 测试服务器充当 API，覆盖：断点续传、未变化容器增量跳过、--full 全量重拉、价格查询 single-flight 合并
+运行需要 AstrBot 环境 (astrbot 未安装时自动跳过)
+"""
+import asyncio
+import importlib.util
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("astrbot.api.all")
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN = "1"
+
+
+def _load_main():
+    if "main" in sys.modules:
+        return sys.modules["main"]
+    spec = importlib.util.spec_from_file_location("main", os.path.join(ROOT, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+main = _load_main()
+
+
+class FakeApi:
+    """最小 API 替身：容器列表、容器详情、搜索与商品详情，记录每个接口的调用次数"""
+
+    def __init__(self, containers=3, items=4):
+        self.containers = [
+            {"id": i, "name": f"测试武器箱 {i}", "img": f"/img/case{i}.png", "updated_at": "2024-01-01"}
+            for i in range(containers)
+        ]
+        self.items = items
+        self.fail_ids = set()
+        self.calls = {"list": 0, "detail": 0, "search": 0, "good": 0}
+        self.good_delay = 0.05
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/v1/info/container_data_info", self._list)
+        app.router.add_get("/api/v1/info/good/container_detail", self._detail)
+        app.router.add_get("/api/v1/search/suggest", self._search)
+        app.router.add_get("/api/v1/info/good", self._good)
+        return app
+
+    async def _list(self, request):
+        self.calls["list"] += 1
+        return web.json_response({"code": 200, "data": self.containers})
+
+    async def _detail(self, request):
+        self.calls["detail"] += 1
+        cid = int(request.query["id"])
+        if cid in self.fail_ids:
+            return web.json_response({"code": 500, "msg": "busy"})
+        rarities = ["军规级", "受限", "保密", "隐秘"]
+        data = [
+            {"short_name": f"武器 {cid}-{n} | 测试", "rln": rarities[n % len(rarities)], "img": f"/img/{cid}_{n}.png"}
+            for n in range(self.items)
+        ]
+        return web.json_response({"code": 200, "data": data})
+
+    async def _search(self, request):
+        self.calls["search"] += 1
+        return web.json_response({"code": 200, "data": [{"id": 7, "value": request.query["text"]}]})
+
+    async def _good(self, request):
+        self.calls["good"] += 1
+        await asyncio.sleep(self.good_delay)
+        return web.json_response({"code": 200, "data": {"goods_info": {
+            "name": "AK-47 | 红线", "buff_sell_price": 100, "yyyp_sell_price": 99,
+            "steam_sell_price": 120, "img": "https://example.invalid/ak.png", "updated_at": "2024-01-01"}}})
+
+
+class FakeEvent:
+    def __init__(self, msg, uid=ADMIN, gid="7"):
+        self.message_str = msg
+        self._uid = uid
+        self.message_obj = type("Msg", (), {"group_id": gid})()
+        self.unified_msg_origin = f"test:GroupMessage:{gid}"
+
+    def get_sender_id(self):
+        return self._uid
+
+    def get_platform_name(self):
+        return "aiocqhttp"
+
+    def plain_result(self, text):
+        return text
+
+    def chain_result(self, chain):
+        return chain
+
+
+async def _send(plugin, msg):
+    return [r async for r in plugin.on_group_message(FakeEvent(msg)) if isinstance(r, str)]
+
+
+def _run_with_plugin(api, scenario):
+    """启动 API 替身与插件，执行 scenario(plugin)，结束后释放资源"""
+    async def runner():
+        server = TestServer(api.app(), host="127.0.0.1")
+        await server.start_server()
+        plugin = main.CasePlugin(main.Context(), {
+            "admins": ADMIN,
+            "api_host": f"http://127.0.0.1:{server.port}",
+            "api_request_interval": 0.05,
+            "sync_concurrency": 2,
+        })
+        try:
+            return await scenario(plugin)
+        finally:
+            await plugin.terminate()
+            await server.close()
+    return asyncio.run(runner())
+
+
+@pytest.fixture(autouse=True)
+def _isolated_data_dir(tmp_path, monkeypatch):
+    # 插件的数据路径均相对于工作目录
+    monkeypatch.chdir(tmp_path)
+
+
+def test_full_sync_then_incremental_skips_unchanged():
+    api = FakeApi(containers=3)
+
+    async def scenario(plugin):
+        first = await _send(plugin, "更新武器箱")
+        detail_after_first = api.calls["detail"]
+        second = await _send(plugin, "更新武器箱")
+        return first, detail_after_first, second, plugin
+
+    first, detail_after_first, second, plugin = _run_with_plugin(api, scenario)
+    assert "API 请求 4 次" in first[-1]
+    assert detail_after_first == 3
+    assert api.calls["detail"] == 3
+    assert "API 请求 1 次" in second[-1]
+    assert "跳过未变化 3 个" in second[-1]
+    assert len(plugin.catalog.case_data) == 3
+
+
+def test_changed_container_is_refetched():
+    api = FakeApi(containers=3)
+
+    async def scenario(plugin):
+        await _send(plugin, "更新武器箱")
+        api.containers[1]["updated_at"] = "2024-02-01"
+        return await _send(plugin, "更新武器箱")
+
+    result = _run_with_plugin(api, scenario)
+    assert api.calls["detail"] == 4
+    assert "API 请求 2 次" in result[-1]
+    assert "跳过未变化 2 个" in result[-1]
+    # 列表字段变了但详情一致
+    assert "重新拉取但内容未变 1 个" in result[-1]
+
+
+def test_full_flag_refetches_everything():
+    api = FakeApi(containers=3)
+
+    async def scenario(plugin):
+        await _send(plugin, "更新武器箱")
+        return await _send(plugin, "更新武器箱 --full")
+
+    result = _run_with_plugin(api, scenario)
+    assert "全量" in result[0]
+    assert api.calls["detail"] == 6
+    assert "API 请求 4 次" in result[-1]
+    assert "重新拉取但内容未变 3 个" in result[-1]
+
+
+def test_resume_from_checkpoint_after_failure():
+    api = FakeApi(containers=4)
+    api.fail_ids = {2}
+
+    async def scenario(plugin):
+        failed = await _send(plugin, "更新武器箱")
+        api.fail_ids.clear()
+        resumed = await _send(plugin, "更新武器箱")
+        return failed, resumed, plugin
+
+    failed, resumed, plugin = _run_with_plugin(api, scenario)
+    assert "1 个容器拉取失败" in failed[-1]
+    assert "从断点继续 (已完成 3)" in resumed[0]
+    # 首轮 4 次 (1 次失败)，续传只重拉失败的那一个
+    assert api.calls["detail"] == 5
+    assert "API 请求 2 次" in resumed[-1]
+    assert len(plugin.catalog.case_data) == 4
+
+
+def test_price_queries_are_coalesced():
+    api = FakeApi()
+
+    async def scenario(plugin):
+        svc = plugin.price_svc
+        results = await asyncio.gather(*(svc.get_price("AK-47 红线") for _ in range(5)))
+        again = await svc.get_price("ak-47   红线")
+        return results, again, dict(svc.metrics)
+
+    results, again, metrics = _run_with_plugin(api, scenario)
+    assert len(set(results)) == 1 and "BUFF: 100" in results[0]
+    assert again == results[0]
+    assert api.calls["search"] == 1
+    assert api.calls["good"] == 1
+    assert metrics["upstream"] == 2
+    assert metrics["coalesced"] > 0